@@ -1,13 +1,22 @@
 import streamlit as st
 import pandas as pd
-import numpy as np
-import io
-import time 
-import os 
-import tempfile # NEW: Required for the robust SPSS file handling fix
+import gzip
+import re
+from validation_core import (
+    load_data_file,
+    generate_skip_spss_syntax,
+    generate_piping_spss_syntax,
+    generate_sq_spss_syntax,
+    generate_straightliner_spss_syntax,
+    generate_mq_spss_syntax,
+    generate_string_spss_syntax,
+    generate_master_spss_syntax,
+)
 
 # --- Configuration ---
-FLAG_PREFIX = "xx" 
+# One whole-number token of the comma-separated stub list ("1, 3, 5"); malformed tokens are skipped
+_STUB_RE = re.compile(r'(?:^|,)\s*(\d+)\s*(?=,|$)')
+
 st.set_page_config(layout="wide")
 st.title("📊 Survey Data Validation Automation (Variable-Centric Model)")
 st.markdown("Generates **KnowledgeExcel-compatible SPSS `IF` logic syntax** (`xx` prefix) by allowing **batch selection** and **sequential rule configuration**.")
@@ -40,242 +49,6 @@ for k in [
         st.session_state[k] = []
 
     
-# --- DATA LOADING FUNCTION ---
-def load_data_file(uploaded_file):
-    """Reads data from CSV, Excel, or SPSS data files, handling different formats."""
-    
-    file_extension = os.path.splitext(uploaded_file.name)[1].lower()
-    
-    # Define NA values for CSV/Excel
-    na_values = ['', ' ', '#N/A', 'N/A', 'NA', '#NA', 'NULL', 'null']
-    
-    if file_extension in ['.csv']:
-        # Try common encodings for CSV
-        try:
-            # Attempt UTF-8 first
-            uploaded_file.seek(0) # Ensure pointer is at start
-            return pd.read_csv(uploaded_file, encoding='utf-8', na_values=na_values, keep_default_na=True)
-        except Exception:
-            try:
-                # Reset file pointer and try Latin-1
-                uploaded_file.seek(0)
-                return pd.read_csv(uploaded_file, encoding='latin-1', na_values=na_values, keep_default_na=True)
-            except Exception as e:
-                raise Exception(f"Failed to read CSV with both UTF-8 and Latin-1 encodings. Error: {e}")
-    
-    elif file_extension in ['.xlsx', '.xls']:
-        # Excel files
-        uploaded_file.seek(0) # Ensure pointer is at start
-        return pd.read_excel(uploaded_file)
-    
-    # CORRECTED LOGIC FOR SPSS FILES (.sav, .zsav) - Uses Temporary File Path
-    elif file_extension in ['.sav', '.zsav']:
-        tmp_path = None
-        try:
-            # 1. Use tempfile to create a path that pd.read_spss will accept
-            # This is the most reliable way to handle the "expected str, bytes... not BytesIO" error.
-            with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as tmp_file:
-                # 2. Write the content of the UploadedFile to the temporary file
-                tmp_file.write(uploaded_file.getbuffer())
-                tmp_path = tmp_file.name
-            
-            # 3. Read the data using the temporary file path
-            df = pd.read_spss(tmp_path, convert_categoricals=False)
-            
-            # 4. Clean up the temporary file immediately
-            os.remove(tmp_path)
-            
-            return df
-            
-        except ImportError:
-            st.error("Error: Reading SPSS files requires the 'pyreadstat' library. Please ensure it is in your requirements.txt.")
-            raise
-        except Exception as e:
-            # Ensure file is removed if an error occurred during read
-            if tmp_path and os.path.exists(tmp_path):
-                os.remove(tmp_path)
-            raise Exception(f"Failed to read SPSS data file. Please ensure it is a valid .sav or .zsav file. Error: {e}")
-    
-    else:
-        raise Exception(f"Unsupported file format: {file_extension}. Please upload CSV, Excel (.xlsx/.xls), or SPSS (.sav/.zsav).")
-
-
-# --- CORE UTILITY FUNCTIONS (SYNTAX GENERATION) ---
-
-def generate_skip_spss_syntax(target_col, trigger_col, trigger_val, rule_type, range_min=None, range_max=None):
-    """
-    Generates detailed SPSS syntax for Skip Logic (Error of Omission/Commission)
-    using the two-stage process: Flag_Qx (intermediate filter) -> xxQx (final EoO/EoC flag).
-    """
-    if '_' in target_col:
-        target_clean = target_col.split('_')[0]
-    else:
-        target_clean = target_col
-        
-    filter_flag = f"Flag_{target_clean}" 
-    final_error_flag = f"{FLAG_PREFIX}{target_clean}" 
-    
-    syntax = []
-    
-    # Stage 1: Filter Flag (Flag_Qx)
-    syntax.append(f"**************************************SKIP LOGIC FILTER FLAG: {trigger_col}={trigger_val} -> {target_clean}")
-    syntax.append(f"* Qx should ONLY be asked if {trigger_col} = {trigger_val}.")
-    syntax.append(f"IF({trigger_col} = {trigger_val}) {filter_flag}=1.")
-    syntax.append(f"EXECUTE.\n") 
-    
-    if rule_type == 'SQ' and range_min is not None and range_max is not None:
-        # EoO: Trigger met AND (Missing OR Out-of-Range)
-        eoo_condition = f"(miss({target_col}) | ~range({target_col},{range_min},{range_max}))"
-        # EoC: Trigger NOT met AND (Answered)
-        eoc_condition = f"~miss({target_col})" 
-        
-    elif rule_type == 'String':
-        eoo_condition = f"{target_col}=''"
-        eoc_condition = f"{target_col}<>''"
-        
-    else: # MQ/Ranking/General
-        eoo_condition = f"miss({target_col})"
-        eoc_condition = f"~miss({target_col})" 
-        
-    # --- EoO/EoC Logic ---
-    syntax.append(f"**************************************SKIP LOGIC EoO/EoC CHECK: {target_col} -> {final_error_flag}")
-    
-    # Error of Omission (EoO) - Flag=1
-    syntax.append(f"* EoO (1): Trigger Met ({filter_flag}=1), Target Fails Check/Missing/Out-of-Range/Empty.")
-    syntax.append(f"IF({filter_flag} = 1 & {eoo_condition}) {final_error_flag}=1.")
-    
-    # Error of Commission (EoC) - Flag=2
-    syntax.append(f"* EoC (2): Trigger Not Met ({filter_flag}<>1 | miss({filter_flag})), Target Answered.")
-    syntax.append(f"IF(({filter_flag} <> 1 | miss({filter_flag})) & {eoc_condition}) {final_error_flag}=2.")
-    
-    syntax.append("EXECUTE.\n")
-    
-    return syntax, [filter_flag, final_error_flag]
-
-
-def generate_other_specify_spss_syntax(main_col, other_col, other_stub_val):
-    """
-    Generates syntax for Other-Specify checks (Both forward and reverse conditions).
-    """
-    syntax = []
-    if '_' in main_col:
-        main_clean = main_col.split('_')[0]
-    else:
-        main_clean = main_col
-        
-    flag_name_fwd = f"{FLAG_PREFIX}{main_clean}_OtherFwd"
-    flag_name_rev = f"{FLAG_PREFIX}{main_clean}_OtherRev"
-    
-    # Forward Check (Main selected, Other is empty/missing) - EoO type check
-    syntax.append(f"**************************************OTHER SPECIFY (Forward) Check: {main_col}={other_stub_val} AND {other_col} is missing/blank")
-    syntax.append(f"* EoO (1): Main selected ({main_col}={other_stub_val}), Other is missing/blank.")
-    syntax.append(f"IF({main_col}={other_stub_val} & ({other_col}='' | miss({other_col}))) {flag_name_fwd}=1.")
-    syntax.append(f"EXECUTE.\n")
-    
-    # Reverse Check (Other answered, Main not selected) - EoC type check
-    syntax.append(f"**************************************OTHER SPECIFY (Reverse) Check: {other_col} has data AND {main_col}<>{other_stub_val}")
-    syntax.append(f"* EoC (2): Other has data (~miss({other_col}) & {other_col}<>''), Main not selected.")
-    syntax.append(f"IF(~miss({other_col}) & {other_col}<>'' & {main_col}<>{other_stub_val}) {flag_name_rev}=1.")
-    syntax.append(f"EXECUTE.\n")
-    
-    return syntax, [flag_name_fwd, flag_name_rev]
-
-def generate_piping_spss_syntax(target_col, overall_skip_filter_flag, piping_source_col, piping_stub_val):
-    """
-    Generates syntax for the Rating Piping/Reverse Condition check.
-    """
-    syntax = []
-    
-    flag_col = f"{FLAG_PREFIX}{target_col}" 
-    
-    # 1. Error of Omission (EOO) - Target is missing/wrong when piping condition is met
-    syntax.append(f"**************************************PIPING (EOO) Check: (Filter={overall_skip_filter_flag}=1) AND ({piping_source_col}={piping_stub_val}) AND {target_col}<>{piping_stub_val}")
-    syntax.append(f"* EoO (1): Piping/Skip met, Target value is wrong/missing. IF(((Flag_Q12=1) & Q11=1 ) & Q12_1<>1)xxQ12_1=1.")
-    syntax.append(f"IF(({overall_skip_filter_flag}=1) & ({piping_source_col}={piping_stub_val}) & {target_col}<>{piping_stub_val}) {flag_col}=1.")
-    
-    # 2. Error of Commission (EOC / Reverse Condition) - Target has data when piping condition is NOT met
-    syntax.append(f"**************************************PIPING (EOC / Reverse) Check: (Filter NOT met OR Piping NOT met) AND {target_col} is answered")
-    syntax.append(f"* EoC (2): Skip/Piping not met, Target value is wrongly answered. IF((Flag_Q12<>1 | miss(Flag_Q12) | Q11<>1 | miss(Q11)) & ~miss(Q12_1))xxQ12_1=2.")
-    
-    # EOC Condition: (Flag_Qx<>1 OR miss(Flag_Qx) OR Q_source<>i OR miss(Q_source)) AND ~miss(Target)
-    eoc_condition = f"({overall_skip_filter_flag}<>1 | miss({overall_skip_filter_flag}) | {piping_source_col}<>{piping_stub_val} | miss({piping_source_col})) & ~miss({target_col})"
-    syntax.append(f"IF({eoc_condition}) {flag_col}=2.")
-    syntax.append("EXECUTE.\n")
-    
-    return syntax, [flag_col]
-
-
-def generate_sq_spss_syntax(rule):
-    """Generates detailed SPSS syntax for a single Single Select check."""
-    col = rule['variable']
-    min_val = rule['min_val']
-    max_val = rule['max_val']
-    required_stubs_list = rule['required_stubs']
-    
-    if '_' in col:
-        target_clean = col.split('_')[0]
-    else:
-        target_clean = col
-        
-    filter_flag = f"Flag_{target_clean}" 
-        
-    syntax = []
-    generated_flags = []
-
-    # 1. Missing/Range Check 
-    if not rule['run_piping_check']:
-        flag_name = f"{FLAG_PREFIX}{col}_Rng"
-        syntax.append(f"**************************************SQ Missing/Range Check: {col} (Range: {min_val} to {max_val})")
-        syntax.append(f"IF(miss({col}) | ~range({col},{min_val},{max_val})) {flag_name}=1.")
-        syntax.append(f"EXECUTE.\n")
-        generated_flags.append(flag_name)
-    
-    # 2. Specific Stub Check (ANY)
-    if required_stubs_list:
-        stubs_str = ', '.join(map(str, required_stubs_list))
-        flag_any = f"{FLAG_PREFIX}{col}_Any"
-        syntax.append(f"**************************************SQ Specific Stub Check (Not IN Acceptable List): {col} (Accept: {stubs_str})")
-        syntax.append(f"IF(~miss({col}) & NOT(any({col}, {stubs_str}))) {flag_any}=1.")
-        syntax.append(f"EXECUTE.\n")
-        generated_flags.append(flag_any)
-
-    # 3. Other Specify Check
-    if rule.get('other_var') and rule['other_var'] != '-- Select Variable --':
-        other_syntax, other_flags = generate_other_specify_spss_syntax(col, rule['other_var'], rule['other_stub_val'])
-        syntax.extend(other_syntax)
-        generated_flags.extend(other_flags)
-
-    # --- Combined Skip/Piping Checks ---
-    if (rule['run_skip'] or rule['run_piping_check']) and rule['trigger_col'] != '-- Select Variable --':
-        
-        trigger_col = rule['trigger_col']
-        trigger_val = rule['trigger_val']
-        
-        # B. Generate Filter Flag (Flag_Qx)
-        syntax.append(f"**************************************SQ Filter Flag for Skip/Piping: {filter_flag}")
-        syntax.append(f"* Filter for {target_clean}: {trigger_col} = {trigger_val}.")
-        syntax.append(f"IF({trigger_col} = {trigger_val}) {filter_flag}=1.")
-        syntax.append(f"EXECUTE.\n")
-        generated_flags.append(filter_flag)
-        
-        # C. Piping/Reverse Condition Check
-        if rule['run_piping_check'] and rule['piping_source_col'] != '-- Select Variable --':
-            pipe_syntax, pipe_flags = generate_piping_spss_syntax(
-                col, filter_flag, rule['piping_source_col'], rule['piping_stub_val']
-            )
-            syntax.extend(pipe_syntax)
-            generated_flags.extend(pipe_flags)
-        
-        # D. Standard Skip Logic (EoO/EoC) - Only if Piping is NOT run on this specific variable
-        elif rule['run_skip']:
-            sl_syntax, sl_flags = generate_skip_spss_syntax(
-                col, trigger_col, trigger_val, 'SQ', min_val, max_val
-            )
-            syntax.extend(sl_syntax)
-            generated_flags.extend(sl_flags)
-        
-    return syntax, generated_flags 
-
 def configure_sq_rules(all_variable_options):
     """Handles batch selection and sequential configuration of SQ rules."""
     st.subheader("1. Single Select / Rating Rule (SQ) Configuration")
@@ -293,13 +66,18 @@ def configure_sq_rules(all_variable_options):
         st.info(f"Configuring **{len(st.session_state.sq_batch_vars)}** selected SQ variables one-by-one below.")
         
         sq_config_form_key = 'sq_config_form'
+        # Option -> position map for the selectbox defaults (one hash lookup instead of a list scan per widget)
+        option_index = {v: i for i, v in enumerate(all_variable_options)}
+        # Saved rules by variable, so each row's defaults are one lookup instead of a scan of all rules
+        existing_by_var = {r['variable']: r for r in st.session_state.sq_rules}
         with st.form(sq_config_form_key):
             new_sq_rules = []
+            n_batch_vars = len(st.session_state.sq_batch_vars)
             
             for i, col in enumerate(st.session_state.sq_batch_vars):
-                st.markdown(f"### ⚙️ Rule Configuration for **{col}** (Variable {i+1}/{len(st.session_state.sq_batch_vars)})")
+                st.markdown(f"### ⚙️ Rule Configuration for **{col}** (Variable {i+1}/{n_batch_vars})")
                 
-                existing_rule = next((r for r in st.session_state.sq_rules if r['variable'] == col), {})
+                existing_rule = existing_by_var.get(col, {})
                 
                 key_prefix = f'sq_{col}_{i}'
                 
@@ -314,7 +92,7 @@ def configure_sq_rules(all_variable_options):
                 stubs_list = existing_rule.get('required_stubs', [])
                 stubs_str_default = ', '.join(map(str, stubs_list)) if stubs_list else ''
                 stubs_str = st.text_input("Specific Acceptable Stubs (e.g., '1, 3, 5' - for ANY check, leave blank if all in range are acceptable)", value=stubs_str_default, key=f'{key_prefix}_stubs')
-                required_stubs = [int(s.strip()) for s in stubs_str.split(',') if s.strip().isdigit()] if stubs_str else None
+                required_stubs = list(map(int, _STUB_RE.findall(stubs_str))) if stubs_str else None
                 
                 # --- B. Other Specify Check ---
                 st.markdown("#### B. Other Specify Check (Forward and Reverse Condition)")
@@ -325,7 +103,7 @@ def configure_sq_rules(all_variable_options):
                 
                 with col_other_var:
                     other_var = st.selectbox("Corresponding 'Other Specify' Variable (Qx_OE/TEXT)", all_variable_options, 
-                                             index=all_variable_options.index(other_var_default) if other_var_default in all_variable_options else 0, 
+                                             index=option_index.get(other_var_default, 0), 
                                              key=f'{key_prefix}_other_var')
                 with col_other_stub:
                     other_stub_val = st.number_input("Stub Value for 'Other' (e.g., 99)", min_value=1, value=other_stub_default, key=f'{key_prefix}_other_stub')
@@ -339,7 +117,7 @@ def configure_sq_rules(all_variable_options):
                 col_t_col, col_t_val = st.columns(2)
                 with col_t_col:
                     skip_trigger_col = st.selectbox("**Filter/Trigger Variable** (e.g., Q0)", all_variable_options, 
-                                                    index=all_variable_options.index(skip_trigger_col_default) if skip_trigger_col_default in all_variable_options else 0, 
+                                                    index=option_index.get(skip_trigger_col_default, 0), 
                                                     key=f'{key_prefix}_t_col')
                 with col_t_val:
                     skip_trigger_val = st.text_input("**Filter Condition Value** (e.g., 1)", value=skip_trigger_val_default, key=f'{key_prefix}_t_val')
@@ -368,10 +146,11 @@ def configure_sq_rules(all_variable_options):
                         col_p_source, col_p_stub = st.columns(2)
                         with col_p_source:
                             pipe_source_col = st.selectbox("Piping Source Column (Q_Source)", all_variable_options, 
-                                                           index=all_variable_options.index(pipe_source_col_default) if pipe_source_col_default in all_variable_options else 0, 
+                                                           index=option_index.get(pipe_source_col_default, 0), 
                                                            key=f'{key_prefix}_p_source')
                         with col_p_stub:
-                            auto_val = int(col.split('_')[-1]) if '_' in col and col.split('_')[-1].isdigit() else 1
+                            _, sep, stub_suffix = col.rpartition('_')
+                            auto_val = int(stub_suffix) if sep and stub_suffix.isdigit() else 1
                             pipe_stub_val = st.number_input(f"Expected Stub Value (Value of {col} must match this if {pipe_source_col} selected)", min_value=1, value=pipe_stub_val_default if existing_rule.get('piping_stub_val') else auto_val, key=f'{key_prefix}_p_stub')
                     
                 else:
@@ -402,7 +181,8 @@ def configure_sq_rules(all_variable_options):
                 })
             
             if st.form_submit_button("✅ Save ALL Configured SQ Rules"):
-                existing_vars_to_keep = [r for r in st.session_state.sq_rules if r['variable'] not in st.session_state.sq_batch_vars]
+                batch_set = set(st.session_state.sq_batch_vars)
+                existing_vars_to_keep = [r for r in st.session_state.sq_rules if r['variable'] not in batch_set]
                 
                 for rule in new_sq_rules:
                     existing_vars_to_keep.append(rule)
@@ -415,35 +195,6 @@ def configure_sq_rules(all_variable_options):
             else:
                 st.markdown("Submit the form above to save the configured rules.")
 
-# NEW FUNCTION: Generate Straightliner Syntax
-def generate_straightliner_spss_syntax(cols):
-    """
-    Generates SPSS syntax for a Maximum Straightliner check (MIN=MAX).
-    This flags respondents who gave the exact same answer for all items in the grid.
-    """
-    cols_str = ' '.join(cols)
-    set_name = cols[0].split('_')[0] if cols else 'Rating_Set'
-    flag_name_max_str = f"{FLAG_PREFIX}{set_name}_MaxStr"
-    
-    syntax = []
-    
-    syntax.append(f"**************************************STRAIGHTLINER CHECK: {set_name} (Max: All Items Same Value)")
-    syntax.append(f"* Check if the minimum value equals the maximum value across the grid items for a single respondent.")
-    
-    # Calculate MIN and MAX for the row/case
-    syntax.append(f"COMPUTE #Min_Val = MIN({cols_str}).")
-    syntax.append(f"COMPUTE #Max_Val = MAX({cols_str}).")
-    
-    # Flag 1 if MIN = MAX AND at least one item is answered (to ignore fully missing cases)
-    syntax.append(f"IF(#Min_Val = #Max_Val & ~miss({cols[0]})) {flag_name_max_str}=1.")
-    syntax.append(f"EXECUTE.\n")
-    
-    # Clean up temporary variables
-    syntax.append(f"DELETE VARIABLES #Min_Val #Max_Val.")
-    syntax.append(f"EXECUTE.\n")
-
-    return syntax, [flag_name_max_str]
-
 # NEW FUNCTION: Configure Straightliner Rules
 def configure_straightliner_rules():
     """Handles the configuration of Straightliner checks for rating grids."""
@@ -474,67 +225,6 @@ def configure_straightliner_rules():
                         st.warning("Please select at least two columns for the Straightliner check.")
 
 
-# MQ functions remain here...
-def generate_mq_spss_syntax(rule):
-    """Generates detailed SPSS syntax for a Multi-Select check."""
-    cols = rule['variables']
-    mq_set_name = cols[0].split('_')[0] if cols else 'MQ_Set'
-    mq_list_str = ' '.join(cols)
-    calc_func = "SUM" if rule['count_method'] == "SUM" else "COUNT"
-    mq_sum_var = f"{mq_set_name}_Count"
-
-    syntax = []
-    generated_flags = []
-    
-    # 1. Count Calculation
-    syntax.append(f"**************************************MQ Count Calculation for Set: {mq_set_name} (Method: {calc_func})")
-    syntax.append(f"COMPUTE {mq_sum_var} = {calc_func}({mq_list_str}).") 
-    syntax.append(f"EXECUTE.\n")
-    generated_flags.append(mq_sum_var)
-    
-    # 2. Min/Max Count Check
-    flag_min = f"{FLAG_PREFIX}{mq_set_name}_Min"
-    syntax.append(f"**************************************MQ Minimum Count Check: {mq_set_name} (Min: {rule['min_count']})")
-    syntax.append(f"IF({mq_sum_var} < {rule['min_count']} & ~miss({cols[0]})) {flag_min}=1.") 
-    syntax.append(f"EXECUTE.\n")
-    generated_flags.append(flag_min)
-    
-    if rule['max_count'] and rule['max_count'] > 0:
-        flag_max = f"{FLAG_PREFIX}{mq_set_name}_Max"
-        syntax.append(f"**************************************MQ Maximum Count Check: {mq_set_name} (Max: {rule['max_count']})")
-        syntax.append(f"IF({mq_sum_var} > {rule['max_count']}) {flag_max}=1.")
-        syntax.append(f"EXECUTE.\n")
-        generated_flags.append(flag_max)
-
-    # 3. Exclusive Stub Check
-    if rule['exclusive_col'] and rule['exclusive_col'] != 'None' and rule['exclusive_col'] in cols:
-        flag_exclusive = f"{FLAG_PREFIX}{mq_set_name}_Exclusive"
-        exclusive_value = 1 
-        other_cols_str = ' '.join([c for c in cols if c != rule['exclusive_col']])
-        syntax.append(f"**************************************MQ Exclusive Stub Check: {rule['exclusive_col']} vs Others")
-        syntax.append(f"COMPUTE #Other_Count = SUM({other_cols_str}).")
-        syntax.append(f"IF({rule['exclusive_col']}={exclusive_value} & #Other_Count > 0) {flag_exclusive}=1.")
-        syntax.append("EXECUTE.\n")
-        generated_flags.append(flag_exclusive)
-        syntax.append("DELETE VARIABLES #Other_Count.\n") 
-
-    # 4. Other Specify Check
-    if rule.get('other_var') and rule['other_var'] != 'None' and rule.get('other_checkbox_col') and rule['other_checkbox_col'] != 'None':
-         other_syntax, other_flags = generate_other_specify_spss_syntax(rule['other_checkbox_col'], rule['other_var'], rule['other_stub_val'])
-         syntax.extend(other_syntax)
-         generated_flags.extend(other_flags)
-
-    # 5. Skip Logic (EoO/EoC) - uses the base question name as proxy
-    if rule['run_skip'] and rule['trigger_col'] != '-- Select Variable --':
-        target_col = mq_set_name 
-        sl_syntax, sl_flags = generate_skip_spss_syntax(
-            target_col, rule['trigger_col'], rule['trigger_val'], 'MQ'
-        )
-        syntax.extend(sl_syntax)
-        generated_flags.extend(sl_flags)
-
-    return syntax, generated_flags
-
 def configure_mq_rules(all_variable_options):
     """Handles configuration of MQ rules."""
     st.subheader("3. Multi-Select Rule (MQ) Configuration")
@@ -616,43 +306,7 @@ def configure_mq_rules(all_variable_options):
                     else:
                         st.warning("Please select columns for the MQ group.")
 
-def generate_string_spss_syntax(rule):
-    """
-    Generates detailed SPSS syntax for a String check.
-    """
-    col = rule['variable']
-    min_length = rule['min_length']
-    
-    syntax = []
-    generated_flags = []
-
-    # 1. Junk/Min Length Check 
-    if min_length and min_length > 0:
-        flag_length = f"{FLAG_PREFIX}{col}_Junk"
-        syntax.append(f"**************************************String Junk Check: {col} (Min Length: {min_length} chars)")
-        # Flag 1 if answered (not miss or '') AND length < min_length
-        syntax.append(f"IF(~miss({col}) & {col}<>'' & LENGTH(RTRIM({col})) < {min_length}) {flag_length}=1.")
-        syntax.append(f"EXECUTE.\n")
-        generated_flags.append(flag_length)
-    
-    # 2. Explicit Missing Check (Only run if NO skip logic is enabled)
-    if not rule['run_skip']:
-        flag_missing = f"{FLAG_PREFIX}{col}_Miss"
-        syntax.append(f"**************************************String Missing Check: {col} (Missing Mandatory Check)")
-        # Flag 1 if missing or empty string
-        syntax.append(f"IF({col}='' | miss({col})) {flag_missing}=1.")
-        syntax.append(f"EXECUTE.\n")
-        generated_flags.append(flag_missing)
-        
-    # 3. Skip Logic (EoO/EoC) 
-    if rule['run_skip'] and rule['trigger_col'] != '-- Select Variable --':
-        sl_syntax, sl_flags = generate_skip_spss_syntax(
-            col, rule['trigger_col'], rule['trigger_val'], 'String'
-        )
-        syntax.extend(sl_syntax)
-        generated_flags.extend(sl_flags)
-        
-    return syntax, generated_flags
+@st.fragment
 def configure_string_rules(all_variable_options):
     """
     FINAL LOCKED VERSION
@@ -675,15 +329,15 @@ def configure_string_rules(all_variable_options):
     if not st.session_state.string_batch_vars:
         return
 
+    option_index = {v: i for i, v in enumerate(all_variable_options)}
+    existing_by_var = {r['variable']: r for r in st.session_state.string_rules}
+
     # Loop through each OE variable
     for i, col in enumerate(st.session_state.string_batch_vars):
 
         st.markdown(f"### {col}")
 
-        existing = next(
-            (r for r in st.session_state.string_rules if r['variable'] == col),
-            {}
-        )
+        existing = existing_by_var.get(col, {})
 
         key = f"oe_{i}"
 
@@ -704,8 +358,7 @@ def configure_string_rules(all_variable_options):
                 trigger_col = st.selectbox(
                     "Parent / Controlling Question",
                     all_variable_options,
-                    index=all_variable_options.index(existing.get('trigger_col'))
-                    if existing.get('trigger_col') in all_variable_options else 0,
+                    index=option_index.get(existing.get('trigger_col'), 0),
                     key=f"{key}_tcol_ui"
                 )
             with c2:
@@ -749,182 +402,6 @@ def configure_string_rules(all_variable_options):
                 st.rerun()
 
 
-# Ranking functions remain here...
-
-def generate_ranking_spss_syntax(rule):
-    """Generates detailed SPSS syntax for a Ranking check."""
-    cols = rule['variables']
-    min_rank = rule['min_rank']
-    max_rank = rule['max_rank']
-    rank_set_name = cols[0].split('_')[0] if cols else 'Rank_Set'
-    rank_list_str = ' '.join(cols)
-    
-    syntax = []
-    generated_flags = []
-    
-    # 1. Duplicate Rank Check
-    flag_duplicate = f"{FLAG_PREFIX}{rank_set_name}_Dup"
-    syntax.append(f"**************************************Ranking Duplicate Check: {rank_set_name}")
-    syntax.append(f"COMPUTE {flag_duplicate} = 0.")
-    syntax.append(f"LOOP #rank = {min_rank} TO {max_rank}.")
-    syntax.append(f"  COUNT #rank_count = {rank_list_str} (#rank).")
-    syntax.append(f"  IF(#rank_count > 1) {flag_duplicate}=1.")
-    syntax.append(f"END LOOP.")
-    syntax.append(f"EXECUTE.\n")
-    generated_flags.append(flag_duplicate)
-    
-    # 2. Rank Range Check
-    flag_range_name = f"{FLAG_PREFIX}{rank_set_name}_Rng"
-    syntax.append(f"**************************************Ranking Range Check: {rank_set_name} (Range: {min_rank} to {max_rank})")
-    syntax.append(f"COMPUTE {flag_range_name} = 0.")
-    for col in cols:
-        syntax.append(f"IF(~miss({col}) & ~range({col},{min_rank},{max_rank})) {flag_range_name}=1.")
-    syntax.append(f"EXECUTE.\n")
-    generated_flags.append(flag_range_name)
-    
-    # 3. Skip Logic (EoO/EoC) - uses the base variable name as proxy
-    if rule['run_skip'] and rule['trigger_col'] != '-- Select Variable --':
-        target_col = rank_set_name
-        sl_syntax, sl_flags = generate_skip_spss_syntax(
-            target_col, rule['trigger_col'], rule['trigger_val'], 'Ranking'
-        )
-        syntax.extend(sl_syntax)
-        generated_flags.extend(sl_flags)
-        
-    return syntax, generated_flags
-
-def generate_master_spss_syntax(sq_rules, mq_rules, ranking_rules, string_rules, straightliner_rules):
-    """Generates the final .sps file by iterating over all stored rules."""
-    all_syntax_blocks = []
-    all_flag_cols = []
-    
-    # Process Rules
-    for rule in sq_rules:
-        syntax, flags = generate_sq_spss_syntax(rule)
-        all_syntax_blocks.append(syntax)
-        all_flag_cols.extend(flags)
-        
-    for rule in mq_rules:
-        syntax, flags = generate_mq_spss_syntax(rule)
-        all_syntax_blocks.append(syntax)
-        all_flag_cols.extend(flags)
-            
-    for rule in ranking_rules:
-        syntax, flags = generate_ranking_spss_syntax(rule)
-        all_syntax_blocks.append(syntax)
-        all_flag_cols.extend(flags)
-
-    for rule in straightliner_rules: # Straightliner Rules
-        syntax, flags = generate_straightliner_spss_syntax(rule['variables'])
-        all_syntax_blocks.append(syntax)
-        all_flag_cols.extend(flags)
-
-    for rule in string_rules:
-        syntax, flags = generate_string_spss_syntax(rule)
-        all_syntax_blocks.append(syntax) # Use all_syntax_blocks, not all_syntax_cols
-        all_flag_cols.extend(flags)
-
-
-    # --- Master Syntax Compilation ---
-    sps_content = []
-    sps_content.append(f"*{'='*60}*")
-    sps_content.append(f"* PYTHON-GENERATED DATA VALIDATION SCRIPT (KNOWLEDGEEXCEL FORMAT) *")
-    sps_content.append(f"*{'='*60}*\n")
-    sps_content.append("DATASET ACTIVATE ALL.")
-    sps_content.append("\n* --- 0. INITIALIZE FLAGS --- *")
-    
-    unique_flag_names = sorted(list(set(all_flag_cols)))
-    
-    # Filter for flags that need initialization (excluding counts/temp vars)
-    init_flags_0 = [f for f in unique_flag_names if f.startswith(FLAG_PREFIX) and not f.endswith(('_Count', '_Miss', '_Junk'))]
-    intermediate_flags = [f for f in unique_flag_names if f.startswith('Flag_')]
-    
-    all_numeric_flags = init_flags_0 + intermediate_flags
-    
-    # String flags (which are numeric but may not have been in the original init_flags_0 list)
-    string_flags = [f for f in unique_flag_names if f.endswith(('_Miss', '_Junk'))]
-    all_numeric_flags.extend(string_flags)
-    all_numeric_flags = sorted(list(set(all_numeric_flags)))
-    
-    if all_numeric_flags:
-        sps_content.append(f"NUMERIC {'; '.join(all_numeric_flags)}.")
-        
-        # Initialize the final flags to 0
-        if init_flags_0:
-            sps_content.append(f"RECODE {'; '.join(init_flags_0)} (ELSE=0).") 
-            
-        # Initialize intermediate flags to 0
-        if intermediate_flags:
-            sps_content.append(f"RECODE {'; '.join(intermediate_flags)} (ELSE=0).") 
-
-        # Initialize string flags to 0
-        if string_flags:
-            sps_content.append(f"RECODE {'; '.join(string_flags)} (ELSE=0).") 
-            
-    sps_content.append("EXECUTE.\n")
-    
-    # 1. Insert ALL detailed validation logic
-    sps_content.append("\n\n* --- 1. DETAILED VALIDATION LOGIC --- *")
-    sps_content.append("\n".join([item for sublist in all_syntax_blocks for item in sublist]))
-    
-    # 2. Add Value Labels & Master Flags
-    sps_content.append("\n* --- 2. VALUE LABELS & VARIABLE INITIALIZATION --- *")
-    
-    for flag in unique_flag_names:
-        
-        if flag.startswith(FLAG_PREFIX) and flag.endswith(('_Rng', '_Any', '_OtherFwd', '_OtherRev', '_Min', '_Max', '_Dup', '_Miss', '_Junk', '_MaxStr')):
-            # General 'Fail: Data Check' for non-EoO/EoC flags
-            sps_content.append(f"VALUE LABELS {flag} 0 'Pass' 1 'Fail: Data Check'.")
-            
-        elif flag.startswith(FLAG_PREFIX) and not flag.endswith('_Count'):
-            # EoO/EoC flags (xxQx)
-            sps_content.append(f"VALUE LABELS {flag} 0 'Pass' 1 'Fail: Error of Omission (EOO)' 2 'Fail: Error of Commission (EoC)'.")
-        
-        elif flag.startswith('Flag_'):
-             # Intermediate skip filter flags
-             sps_content.append(f"VALUE LABELS {flag} 0 'Pass/Filter Not Met' 1 'Filter Flag Met (Intermediate)'.") 
-            
-    sps_content.append("EXECUTE.\n")
-
-    # 3. Compute a Master Reject Flag
-    master_error_flags = [f for f in unique_flag_names if f.startswith(FLAG_PREFIX) or f.startswith('Flag_')]
-    
-    sps_content.append("\n* --- 3. MASTER REJECT COUNT COMPUTATION --- *")
-    if master_error_flags:
-        temp_flag_logic = []
-        
-        # Only count final error flags (xx prefix, excluding calculated counts)
-        error_flags_to_count = [f for f in master_error_flags if f.startswith(FLAG_PREFIX) and not f.endswith('_Count')]
-        
-        if error_flags_to_count:
-            sps_content.append("\n*--- Temporary Binary Flags for Counting ---*")
-            
-            # Use COMPUTE / IF for temporary flags to handle the mix of 0/1 and 0/1/2 flags correctly
-            sps_content.append(f"NUMERIC {'; '.join([f'T_{f}' for f in error_flags_to_count])}.")
-            
-            for flag in error_flags_to_count:
-                temp_name = f"T_{flag}"
-                temp_flag_logic.append(f"IF({flag}>0) {temp_name}=1.") 
-                temp_flag_logic.append(f"ELSE {temp_name}=0.")
-            
-            sps_content.extend(temp_flag_logic)
-            sps_content.append("EXECUTE.\n")
-
-            master_flag_logic = ' + '.join([f'T_{f}' for f in error_flags_to_count])
-            
-            sps_content.append(f"COMPUTE Master_Reject_Count = SUM({master_flag_logic}).")
-            sps_content.append("VARIABLE LABELS Master_Reject_Count 'Total Validation Errors (DV)'.")
-            sps_content.append("EXECUTE.")
-
-            sps_content.append("\nDELETE VARIABLES T_*.")
-            sps_content.append("EXECUTE.")
-            
-            sps_content.append("\n* --- 4. VALIDATION REPORT (Frequencies) --- *")
-            sps_content.append(f"FREQUENCIES VARIABLES=Master_Reject_Count {'; '.join(error_flags_to_count)} /STATISTICS=COUNT MEAN.")
-        
-    return "\n".join(sps_content)
-
-
 # --- UI Utility Functions ---
 
 def clear_all_rules():
@@ -1007,7 +484,7 @@ def display_rules(rules, columns, header, rule_type):
             for j in range(len(current_cols)):
                 rule_index = i + j
                 rule = rules[rule_index]
-                key = f'delete_{rule_type}_{rule_index}_{time.time()}'
+                key = f'delete_{rule_type}_{rule_index}'
                 target_name = rule.get('variable') or (rule.get('variables', ['Group']) + [''])[0]
                 
                 if current_cols[j].button(f"❌ {target_name}", key=key, help=f"Delete rule for {target_name}"):
@@ -1031,8 +508,12 @@ if uploaded_file:
         df_raw = load_data_file(uploaded_file)
         
         st.success(f"Loaded {len(df_raw)} rows and {len(df_raw.columns)} columns from **{uploaded_file.name}**.")
-        st.session_state.all_cols = list(df_raw.columns.tolist())
-        all_variable_options = ['-- Select Variable --'] + st.session_state.all_cols
+        # Column lists only change with the upload, so derive them once per file rather than every rerun
+        if st.session_state.get('options_file_id') != uploaded_file.file_id:
+            st.session_state.all_cols = df_raw.columns.tolist()
+            st.session_state.all_variable_options = ('-- Select Variable --', *st.session_state.all_cols)
+            st.session_state.options_file_id = uploaded_file.file_id
+        all_variable_options = st.session_state.all_variable_options
         
         st.markdown("---")
         st.header("Step 2: Define Validation Rules")
@@ -1070,13 +551,28 @@ if uploaded_file:
         if total_rules > 0:
             
             # --- Generate Master Outputs ---
-            master_spss_syntax = generate_master_spss_syntax(
-                st.session_state.sq_rules, 
-                st.session_state.mq_rules, 
-                st.session_state.ranking_rules, 
+            # Rules only change on form submit, so reuse the last script unless their content differs
+            rules_key = repr((
+                st.session_state.sq_rules,
+                st.session_state.mq_rules,
+                st.session_state.ranking_rules,
                 st.session_state.string_rules,
                 st.session_state.straightliner_rules
-            )
+            ))
+            if st.session_state.get('last_syntax_key') != rules_key:
+                st.session_state.last_syntax_text = generate_master_spss_syntax(
+                    st.session_state.sq_rules, 
+                    st.session_state.mq_rules, 
+                    st.session_state.ranking_rules, 
+                    st.session_state.string_rules,
+                    st.session_state.straightliner_rules
+                )
+                # Encoded once here rather than by the download button on every rerun
+                st.session_state.last_syntax_bytes = st.session_state.last_syntax_text.encode('utf-8')
+                # The script is highly repetitive text, so a compressed copy is a fraction of the download
+                st.session_state.last_syntax_gz = gzip.compress(st.session_state.last_syntax_bytes, compresslevel=6)
+                st.session_state.last_syntax_key = rules_key
+            master_spss_syntax = st.session_state.last_syntax_text
             
             st.success(f"Generated complete syntax for **{total_rules}** validation rules.")
             
@@ -1085,11 +581,19 @@ if uploaded_file:
             with col_a:
                 st.download_button(
                     label="⬇️ Download Master SPSS Syntax (.sps)",
-                    data=master_spss_syntax,
+                    data=st.session_state.last_syntax_bytes,
                     file_name="master_validation_script_knowledgeexcel.sps",
                     mime="text/plain"
                 )
             
+            with col_b:
+                st.download_button(
+                    label="⬇️ Download Compressed Syntax (.sps.gz)",
+                    data=st.session_state.last_syntax_gz,
+                    file_name="master_validation_script_knowledgeexcel.sps.gz",
+                    mime="application/gzip"
+                )
+            
             st.subheader("Preview of Generated Detailed SPSS Logic (Filter/Skip/Straightliner)")
             
             preview_syntax_list = []
@@ -1146,7 +650,7 @@ if uploaded_file:
                 if rule_type == 'string' and not rule.get('run_skip'):
                     syntax, _ = generator_func(rule)
                     # Filter to just the missing check part
-                    missing_check_syntax = [line for line in syntax if '_Miss' in line or '*' in line]
+                    missing_check_syntax = [line for line in "\n".join(syntax).splitlines() if '_Miss' in line or '*' in line]
                     preview_syntax_list.extend(missing_check_syntax)
                     return True
 
@@ -1161,7 +665,7 @@ if uploaded_file:
 
             if preview_syntax_list:
                 st.info("Showing preview of the detailed structure of a configured check:")
-                preview_text = '\n'.join(preview_syntax_list[:40]) 
+                preview_text = '\n'.join('\n'.join(preview_syntax_list).splitlines()[:40]) 
             else:
                 st.info("No detailed logic configured. Showing top of file.")
                 preview_text = '\n'.join(master_spss_syntax.split('\n')[:20]) 
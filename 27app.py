@@ -1,192 +1,425 @@
 import streamlit as st
 import pandas as pd
-import numpy as np
+import hashlib
 import io
 import os 
+import shutil
+import stat
+import sys
 import tempfile
-import re
+from itertools import chain, compress, islice
+from collections import defaultdict
 
 # --- 1. CONFIGURATION & SYSTEM FILTER ---
 FLAG_PREFIX = "xx" 
 # Variables that should never show up in any dropdown
-SYSTEM_VARS = ['sys_respnum', 'status', 'duration', 'starttime', 'endtime', 'uuid', 'recordid', 'respid', 'index', 'id', 'status_code']
+SYSTEM_VARS = frozenset(('sys_respnum', 'status', 'duration', 'starttime', 'endtime', 'uuid', 'recordid', 'respid', 'index', 'id', 'status_code'))
+# Parsed uploads are also kept on disk as parquet (keyed by content hash), so re-uploading a file in a new session skips the parse
+PARQUET_CACHE_DIR = os.path.join(tempfile.gettempdir(), "survey_cache")
+PARQUET_CACHE_MAX_FILES = 16
+# Rule configuration only needs an SPSS file's columns and types (from its header): decode this many rows until Generate
+PREVIEW_ROWS = 1000
+# The Finalize tab shows this many lines of the generated syntax; the download holds all of it
+SYNTAX_PREVIEW_LINES = 200
 
 st.set_page_config(layout="wide", page_title="Survey Data Validation")
 st.title("📊 Survey Data Validation Automation")
 st.markdown("---")
 
 # 2. INITIALIZE SESSION STATE (Fixed to prevent reset loops)
-if 'sq_rules' not in st.session_state: st.session_state.sq_rules = []
-if 'mq_rules' not in st.session_state: st.session_state.mq_rules = []
-if 'string_rules' not in st.session_state: st.session_state.string_rules = []
-if 'straightliner_rules' not in st.session_state: st.session_state.straightliner_rules = []
+# Rules are keyed by variable (SQ/OE) or group name (MQ/Grid): re-saving replaces instead of duplicating
+if 'sq_rules' not in st.session_state: st.session_state.sq_rules = {}
+if 'mq_rules' not in st.session_state: st.session_state.mq_rules = {}
+if 'string_rules' not in st.session_state: st.session_state.string_rules = {}
+if 'straightliner_rules' not in st.session_state: st.session_state.straightliner_rules = {}
 if 'all_cols' not in st.session_state: st.session_state.all_cols = []
-if 'var_types' not in st.session_state: st.session_state.var_types = {}
+if 'str_var_set' not in st.session_state: st.session_state.str_var_set = frozenset()
+if 'groups' not in st.session_state: st.session_state.groups = {}
+if 'group_opts' not in st.session_state: st.session_state.group_opts = ("-- Select --",)
+if 'all_opts' not in st.session_state: st.session_state.all_opts = ("-- Select Variable --",)
+if 'opt_index' not in st.session_state: st.session_state.opt_index = {"-- Select Variable --": 0}
+if 'num_vars' not in st.session_state: st.session_state.num_vars = ()
+if 'str_vars' not in st.session_state: st.session_state.str_vars = ()
+if 'missing_logic' not in st.session_state: st.session_state.missing_logic = {}
+if 'answered_logic' not in st.session_state: st.session_state.answered_logic = {}
+if 'trig_fmt' not in st.session_state: st.session_state.trig_fmt = {}
 if 'sq_batch_vars' not in st.session_state: st.session_state.sq_batch_vars = []
 if 'oe_batch_vars' not in st.session_state: st.session_state.oe_batch_vars = []
+if 'data_key' not in st.session_state: st.session_state.data_key = None
 
 # --- 3. DATA LOADING & SMART GROUPING ---
 
-def load_data_file(uploaded_file):
-    file_extension = os.path.splitext(uploaded_file.name)[1].lower()
+def _parse_upload(file_extension, _uploaded_file, row_limit=0):
     df = None
-    try:
-        if file_extension == '.csv':
-            df = pd.read_csv(uploaded_file, na_values=['', ' ', 'N/A'])
-        elif file_extension in ['.xlsx', '.xls']:
-            df = pd.read_excel(uploaded_file)
-        elif file_extension in ['.sav', '.zsav']:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as tmp:
-                tmp.write(uploaded_file.getbuffer())
-                df = pd.read_spss(tmp.name, convert_categoricals=False)
+    # Readers are imported per branch: only the one the upload needs is ever loaded (later imports hit sys.modules)
+    if file_extension == '.csv':
+        from validation_core import load_data_file as read_shared
+        # The shared reader: Arrow's parallel parser, falling back to pd.read_csv for ragged rows, with
+        # repeated headers renamed Q1.1, ... and date/time columns kept as text (str_vars, not the SQ picker)
+        df = read_shared(_uploaded_file)
+        df = df.drop(columns=df.columns[df.columns.str.lower().isin(SYSTEM_VARS)])
+    elif file_extension in ['.xlsx', '.xls']:
+        df = pd.read_excel(_uploaded_file)
+    elif file_extension in ['.sav', '.zsav']:
+        import pyreadstat
+        with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as tmp:
+            # Stream to disk in 8MB chunks rather than materialising the whole upload first
+            _uploaded_file.seek(0)
+            shutil.copyfileobj(_uploaded_file, tmp, length=8 << 20)
+        try:
+            # Header first, so system variables are never decoded at all
+            _, meta = pyreadstat.read_sav(tmp.name, metadataonly=True)
+            keep = [c for c in meta.column_names if c.lower() not in SYSTEM_VARS]
+            df, _ = pyreadstat.read_sav(tmp.name, usecols=keep, disable_datetime_conversion=True, row_limit=row_limit)
+        finally:
             os.remove(tmp.name)
+    return df
+
+def _private_cache_dir():
+    """Creates the cache directory owner-only (0700). False when it is not a directory owned by this user
+    with no group/other access, so uploads are never read from or written to a directory others can reach."""
+    try:
+        os.makedirs(PARQUET_CACHE_DIR, mode=0o700, exist_ok=True)
+        info = os.lstat(PARQUET_CACHE_DIR)
+    except OSError:
+        return False
+    if not hasattr(os, 'getuid'): return stat.S_ISDIR(info.st_mode)  # Windows: the temp dir is already per-user
+    return stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid() and not info.st_mode & 0o077
+
+def _store_parquet(df, cache_path):
+    """Writes a parsed upload to the disk cache (owner read/write only), then trims it to the most recently used files."""
+    part = f"{cache_path}.{os.getpid()}.part"
+    try:
+        df.to_parquet(part, engine='pyarrow', compression='zstd')
+        os.chmod(part, 0o600)
+        os.replace(part, cache_path)
+        cached = sorted((e for e in os.scandir(PARQUET_CACHE_DIR) if e.name.endswith('.parquet')),
+                        key=lambda e: e.stat().st_mtime, reverse=True)
+        for e in cached[PARQUET_CACHE_MAX_FILES:]: os.remove(e.path)
+    except Exception:
+        # Best effort: a column parquet cannot hold only means this file gets parsed again next session
+        if os.path.exists(part): os.remove(part)
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _read_upload(name, size, file_id, head_hash, _uploaded_file, preview=False):
+    """Parses the upload once per file; every later rerun gets the DataFrame back from the cache.
+    preview=True stops SPSS files after PREVIEW_ROWS rows (a parquet copy of the full file is still used if present)."""
+    file_extension = os.path.splitext(name)[1].lower()
+    digest = hashlib.blake2b(_uploaded_file.getbuffer(), digest_size=16).hexdigest()
+    # No disk cache at all when the directory is not private to this user
+    cache_path = os.path.join(PARQUET_CACHE_DIR, f"{digest}.parquet") if _private_cache_dir() else None
+    if cache_path and os.path.exists(cache_path):
+        os.utime(cache_path)  # mark as recently used for the eviction order
+        return pd.read_parquet(cache_path, engine='pyarrow')
+    row_limit = PREVIEW_ROWS if preview and file_extension in ('.sav', '.zsav') else 0
+    df = _parse_upload(file_extension, _uploaded_file, row_limit)
+    if df is not None:
+        # Survey codes (Likert 1-7, 0/1 boxes) fit int8/int16: downcast whole-number columns once, before caching
+        num_cols = df.select_dtypes('number').columns
+        df[num_cols] = df[num_cols].apply(pd.to_numeric, downcast='integer')
+        if cache_path and not row_limit: _store_parquet(df, cache_path)
+    return df
+
+def load_data_file(uploaded_file, preview=True):
+    try:
+        # Cache key: name/size/upload id plus a hash of the first 1MB, so the full bytes are never hashed per rerun
+        head_hash = hash(uploaded_file.getbuffer()[:1 << 20].tobytes())
+        key = (uploaded_file.name, uploaded_file.size, getattr(uploaded_file, 'file_id', None), head_hash)
+        df = _read_upload(*key, uploaded_file, preview)
             
-        if df is not None:
-            # Filter system variables
-            valid_cols = [c for c in df.columns if c.lower() not in SYSTEM_VARS]
+        # Column-derived state only needs rebuilding when a different file comes in
+        if df is not None and st.session_state.data_key != key:
+            # Filter system variables; interned once so every rule, option tuple and widget key shares one string
+            keep_mask = ~df.columns.str.lower().isin(SYSTEM_VARS)
+            valid_cols = [sys.intern(c) for c in df.columns[keep_mask]]
             st.session_state.all_cols = valid_cols
             
-            # Auto-Detect Types: String vs Numeric
-            st.session_state.var_types = {
-                col: 'String' if df[col].dtype == 'object' or pd.api.types.is_string_dtype(df[col]) else 'Numeric'
-                for col in valid_cols
-            }
-            return df
+            # Auto-Detect Types: String vs Numeric, one mask over the dtypes (object, str and Arrow strings all count)
+            str_mask = df.dtypes.loc[valid_cols].map(pd.api.types.is_string_dtype).to_numpy(dtype=bool)
+            # SQ / OE option lists, partitioned once per file instead of filtered on every rerun
+            st.session_state.num_vars = tuple(compress(valid_cols, ~str_mask))
+            st.session_state.str_vars = tuple(compress(valid_cols, str_mask))
+            # Only string columns are recorded: numeric is the default every lookup falls back to
+            st.session_state.str_var_set = frozenset(st.session_state.str_vars)
+
+            # Pre-render the string-column SPSS conditions the generators reuse (numerics use the helpers' defaults)
+            st.session_state.missing_logic = {col: f"({col} = '' | miss({col}))" for col in st.session_state.str_vars}
+            st.session_state.answered_logic = {col: f"({col} <> '' & ~miss({col}))" for col in st.session_state.str_vars}
+            # Trigger comparison template: quoted value for strings, bare (the default) for numerics
+            st.session_state.trig_fmt = {col: f"{col} = '{{}}'" for col in st.session_state.str_vars}
+
+            # Groups & dropdown options derive from the columns, so build them with the load
+            st.session_state.groups = _compute_groups(valid_cols)
+            st.session_state.group_opts = ("-- Select --", *st.session_state.groups)
+            st.session_state.all_opts = ("-- Select Variable --", *valid_cols)
+            # Option -> position, so each trigger selectbox default is a lookup instead of a list scan
+            st.session_state.opt_index = {v: i for i, v in enumerate(st.session_state.all_opts)}
+            st.session_state.data_key = key
+        return df
     except Exception as e:
         st.error(f"Error loading file: {e}")
     return None
 
-def get_variable_groups():
-    """Detects groups like Q1_1, Q1_2, A4_r1, etc."""
-    groups = {}
-    for col in st.session_state.all_cols:
-        match = re.match(r'^([a-zA-Z0-9]+)_', col)
-        if match:
-            base = match.group(1)
-            if base not in groups: groups[base] = []
-            groups[base].append(col)
+def _compute_groups(cols):
+    """Detects groups like Q1_1, Q1_2, A4_r1, etc. in one pass over the columns."""
+    groups = defaultdict(list)
+    for col in cols:
+        # Grid/group prefix: Q1_1, Q1_2 -> Q1 (an ASCII-alphanumeric stem before the first underscore)
+        base, sep, _ = col.partition('_')
+        if sep and base.isascii() and base.isalnum(): groups[base].append(col)
     return {k: v for k, v in groups.items() if len(v) > 1}
 
 # --- 4. LOGIC HELPERS ---
 
 def is_string(col):
-    return st.session_state.var_types.get(col) == 'String'
+    return col in st.session_state.str_var_set
 
 def get_missing_logic(col):
-    return f"({col} = '' | miss({col}))" if is_string(col) else f"miss({col})"
+    return st.session_state.missing_logic.get(col) or f"miss({col})"
 
 def get_answered_logic(col):
-    return f"({col} <> '' & ~miss({col}))" if is_string(col) else f"~miss({col})"
+    return st.session_state.answered_logic.get(col) or f"~miss({col})"
+
+def get_trigger_logic(col, val):
+    return st.session_state.trig_fmt.get(col, f"{col} = {{}}").format(val)
+
+def is_binary_coded(df, cols):
+    """True when every answered value in the group is 0 or 1, i.e. a checkbox group COUNT can tally."""
+    block = df[cols]
+    return bool((block.isin((0, 1)) | block.isna()).to_numpy().all())
 
 # --- 5. SYNTAX GENERATORS ---
 
 def generate_sq_spss_syntax(rule):
     col = rule['variable']
-    syntax = [f"* SQ Check: {col}"]
-    flag = f"{FLAG_PREFIX}{col}_Rng"
+    missing = get_missing_logic(col)  # one session_state lookup, reused by both checks
     if not is_string(col):
-        syntax.append(f"IF({get_missing_logic(col)} | ~range({col},{rule['min_val']},{rule['max_val']})) {flag}=1.")
+        rng = f"IF({missing} | ~range({col},{rule['min_val']},{rule['max_val']})) {FLAG_PREFIX}{col}_Rng=1."
     else:
-        syntax.append(f"IF({get_missing_logic(col)}) {flag}=1.")
+        rng = f"IF({missing}) {FLAG_PREFIX}{col}_Rng=1."
+    syntax = [f"* SQ Check: {col}", rng]
     if rule.get('trig') and rule['trig'] != "-- Select Variable --":
-        t_logic = f"{rule['trig']} = '{rule['trig_v']}'" if is_string(rule['trig']) else f"{rule['trig']} = {rule['trig_v']}"
-        syntax.append(f"IF({t_logic} & {get_missing_logic(col)}) {FLAG_PREFIX}{col}_Skip=1.")
-    return syntax + ["EXECUTE.\n"]
+        syntax.append(f"IF({get_trigger_logic(rule['trig'], rule['trig_v'])} & {missing}) {FLAG_PREFIX}{col}_Skip=1.")
+    syntax.append("EXECUTE.\n")
+    return syntax
 
 def generate_mq_spss_syntax(rule):
     v_list = " ".join(rule['variables'])
     base = rule['group_name']
-    return [f"* MQ Check: {base}", f"COMPUTE {base}_Sum = SUM({v_list}).", 
+    # 0/1-coded groups: COUNT tallies the selected (=1) boxes natively; any other coding keeps SUM()
+    if rule.get('binary'):
+        tally = f"COUNT {base}_Sum = {v_list} (1)."
+    else:
+        tally = f"COMPUTE {base}_Sum = SUM({v_list})."
+    return [f"* MQ Check: {base}", tally,
             f"IF({base}_Sum < {rule['min_c']} & {get_answered_logic(rule['variables'][0])}) {FLAG_PREFIX}{base}_Min=1.", "EXECUTE.\n"]
 
 def generate_string_spss_syntax(rule):
     col = rule['variable']
-    syntax = [f"* OE Check: {col}", f"IF({get_missing_logic(col)}) {FLAG_PREFIX}{col}_Str=1."]
+    missing = get_missing_logic(col)
+    syntax = [f"* OE Check: {col}", f"IF({missing}) {FLAG_PREFIX}{col}_Str=1."]
     if rule.get('trig') and rule['trig'] != "-- Select Variable --":
-        t_logic = f"{rule['trig']} = '{rule['trig_v']}'" if is_string(rule['trig']) else f"{rule['trig']} = {rule['trig_v']}"
-        syntax.append(f"IF({t_logic} & {get_missing_logic(col)}) {FLAG_PREFIX}{col}_Skip=1.")
-    return syntax + ["EXECUTE.\n"]
+        syntax.append(f"IF({get_trigger_logic(rule['trig'], rule['trig_v'])} & {missing}) {FLAG_PREFIX}{col}_Skip=1.")
+    syntax.append("EXECUTE.\n")
+    return syntax
 
 def generate_straightliner_spss_syntax(rule):
     v_list = " ".join(rule['variables'])
+    first = rule['variables'][0]
+    # One DO REPEAT pass comparing every item to the first (missing items are ignored, like MIN/MAX)
     return [f"* Straightliner: {rule['group_name']}",
-            f"IF(MIN({v_list}) = MAX({v_list}) & {get_answered_logic(rule['variables'][0])}) {FLAG_PREFIX}{rule['group_name']}_Str=1.",
+            "COMPUTE #Same = 1.",
+            f"DO REPEAT X = {v_list}.",
+            f"  IF(X <> {first}) #Same = 0.",
+            "END REPEAT.",
+            f"IF(#Same = 1 & {get_answered_logic(first)}) {FLAG_PREFIX}{rule['group_name']}_Str=1.",
             "EXECUTE.\n"]
 
-# --- 6. UI TABS ---
+# --- 6. VALIDATION PREVIEW ---
+
+@st.cache_data(show_spinner=False)
+def compute_validation_flags(df, sq_rules, mq_rules, string_rules, straightliner_rules, str_var_set):
+    """Runs the main checks on the data with vectorized pandas ops; one boolean column per flag.
+    str_var_set is passed in (not read from session state) so it is part of the cache key."""
+    def blank(s):
+        return s.isna() | s.astype(str).str.strip().eq('')
+
+    def missing(col):
+        return blank(df[col]) if col in str_var_set else df[col].isna()
+
+    def skip_flag(r):
+        """The _Skip check: trigger met but the question left blank (None when the rule has no usable trigger)."""
+        trig = r.get('trig')
+        if not trig or trig == "-- Select Variable --" or trig not in df: return None
+        # Same comparison as get_trigger_logic: quoted text for string triggers, a number otherwise
+        if trig in str_var_set:
+            met = df[trig].astype(str).str.strip().eq(str(r['trig_v']).strip())
+        else:
+            met = df[trig].eq(pd.to_numeric(r['trig_v'], errors='coerce'))
+        return met & missing(r['variable'])
+
+    flags = {}
+    for r in sq_rules.values():
+        if r['variable'] not in df: continue
+        s = df[r['variable']]
+        flags[f"{FLAG_PREFIX}{r['variable']}_Rng"] = blank(s) if r['variable'] in str_var_set else s.isna() | ~s.between(r['min_val'], r['max_val'])
+        skip = skip_flag(r)
+        if skip is not None: flags[f"{FLAG_PREFIX}{r['variable']}_Skip"] = skip
+    for r in mq_rules.values():
+        if not set(r['variables']) <= set(df.columns): continue
+        block = df[r['variables']]
+        tally = block.eq(1).sum(axis=1) if r.get('binary') else block.sum(axis=1)
+        flags[f"{FLAG_PREFIX}{r['group_name']}_Min"] = tally.lt(r['min_c']) & block.iloc[:, 0].notna()
+    for r in string_rules.values():
+        if r['variable'] not in df: continue
+        flags[f"{FLAG_PREFIX}{r['variable']}_Str"] = blank(df[r['variable']])
+        skip = skip_flag(r)
+        if skip is not None: flags[f"{FLAG_PREFIX}{r['variable']}_Skip"] = skip
+    for r in straightliner_rules.values():
+        if not set(r['variables']) <= set(df.columns): continue
+        block = df[r['variables']]
+        flags[f"{FLAG_PREFIX}{r['group_name']}_Str"] = block.nunique(axis=1).eq(1) & block.iloc[:, 0].notna()
+    return pd.DataFrame(flags, index=df.index)
+
+def generate_excel_report(df, flags):
+    """Uploaded data with the 0/1 preview flags appended, as .xlsx bytes."""
+    report = pd.concat([df, flags.astype(int)], axis=1)
+    # Python scalars with None for every missing value, which xlsxwriter leaves as an empty cell
+    report = report.astype(object).where(report.notna(), None)
+    buf = io.BytesIO()
+    # constant_memory flushes each row once a later row is started, so cells must go in row order:
+    # DataFrame.to_excel writes column by column (earlier rows would be dropped), hence write_row per row
+    options = {'constant_memory': True, 'default_date_format': 'yyyy-mm-dd hh:mm:ss', 'remove_timezone': True}
+    with pd.ExcelWriter(buf, engine='xlsxwriter', engine_kwargs={'options': options}) as writer:
+        sheet = writer.book.add_worksheet('Data')
+        sheet.write_row(0, 0, [str(c) for c in report.columns])
+        for i, row in enumerate(report.itertuples(index=False, name=None), start=1):
+            sheet.write_row(i, 0, row)
+    return buf.getvalue()
+
+def show_validation_preview(df):
+    """Failing cases per check plus the .xlsx report download, for the fully read data."""
+    # None means the full read failed, and load_data_file has already reported the error
+    if df is None: return
+    flags = compute_validation_flags(df, st.session_state.sq_rules, st.session_state.mq_rules,
+                                     st.session_state.string_rules, st.session_state.straightliner_rules,
+                                     st.session_state.str_var_set)
+    if not flags.empty:
+        st.markdown("**Preview: failing cases per check in the uploaded data**")
+        st.dataframe(flags.sum().rename("Failing Cases"))
+        st.download_button("Download Validation Report (.xlsx)", generate_excel_report(df, flags), "ValidationReport.xlsx",
+                           mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+
+# --- 7. UI TABS ---
 
 uploaded_file = st.sidebar.file_uploader("Step 1: Upload Data", type=['sav', 'csv', 'xlsx'])
 
 if uploaded_file:
     df = load_data_file(uploaded_file)
     if df is not None:
-        groups = get_variable_groups()
-        all_opts = ["-- Select Variable --"] + st.session_state.all_cols
+        groups = st.session_state.groups
+        all_opts = st.session_state.all_opts
+        opt_index = st.session_state.opt_index
         
         tab_sq, tab_mq, tab_oe, tab_sl, tab_final = st.tabs(["Single Select (SQ)", "Multi-Select (MQ)", "Open Ends (OE)", "Rating Grids", "Finalize"])
         
         with tab_sq:
             st.subheader("Configure Single Select Questions")
-            num_vars = [c for c in st.session_state.all_cols if not is_string(c)]
-            sq_sel = st.multiselect("Select Variables to Configure", num_vars, key="sq_multi")
+            sq_sel = st.multiselect("Select Variables to Configure", st.session_state.num_vars, key="sq_multi")
             if st.button("Configure Selected SQ"):
                 st.session_state.sq_batch_vars = sq_sel
 
             if st.session_state.sq_batch_vars:
                 with st.form("sq_form"):
+                    rows = []
                     for c in st.session_state.sq_batch_vars:
+                        # Rules are keyed by variable, so a saved rule pre-fills its own inputs
+                        saved = st.session_state.sq_rules.get(c, {})
                         st.markdown(f"**Settings for {c}**")
                         c1, c2, c3 = st.columns(3)
-                        mi = c1.number_input(f"Min Valid {c}", 1, key=f"mi_{c}")
-                        ma = c2.number_input(f"Max Valid {c}", 5, key=f"ma_{c}")
-                        tr = c3.selectbox(f"Trigger {c}", all_opts, key=f"tr_{c}")
-                        tv = st.text_input(f"Value {c}", "1", key=f"tv_{c}")
-                        if st.form_submit_button(f"Save {c} Rule"):
-                            st.session_state.sq_rules.append({'variable':c, 'min_val':mi, 'max_val':ma, 'trig':tr, 'trig_v':tv})
-                            st.toast(f"Saved {c}")
+                        mi = c1.number_input(f"Min Valid {c}", value=saved.get('min_val', 1), key=f"mi_{c}")
+                        ma = c2.number_input(f"Max Valid {c}", value=saved.get('max_val', 5), key=f"ma_{c}")
+                        tr = c3.selectbox(f"Trigger {c}", all_opts, index=opt_index.get(saved.get('trig'), 0), key=f"tr_{c}")
+                        tv = st.text_input(f"Value {c}", saved.get('trig_v', "1"), key=f"tv_{c}")
+                        rows.append((c, mi, ma, tr, tv))
+                    # One submit for the whole batch: every row's values are read together
+                    if st.form_submit_button("Save All SQ Rules"):
+                        st.session_state.sq_rules.update(
+                            (c, {'variable':c, 'min_val':mi, 'max_val':ma, 'trig':tr, 'trig_v':tv}) for c, mi, ma, tr, tv in rows
+                        )
+                        st.toast(f"Saved {len(rows)} SQ rules")
 
         with tab_mq:
             st.subheader("Multi-Select Grouping")
-            mq_g = st.selectbox("Select Group (Q1, A4, etc.)", ["-- Select --"] + list(groups.keys()), key="mq_g_sel")
-            mq_v = st.multiselect("Confirm Variables", st.session_state.all_cols, default=groups.get(mq_g, []))
-            if mq_v:
+            mq_g = st.selectbox("Select Group (Q1, A4, etc.)", st.session_state.group_opts, key="mq_g_sel")
+            # The group pick stays outside the form so it can pre-fill the variables below
+            with st.form("mq_form"):
+                mq_v = st.multiselect("Confirm Variables", st.session_state.all_cols, default=groups.get(mq_g, []))
                 min_c = st.number_input("Min selections required", 1, key="mq_min_val")
-                if st.button("Add MQ Rule"):
-                    st.session_state.mq_rules.append({'variables': mq_v, 'min_c': min_c, 'group_name': mq_g if mq_g != "-- Select --" else mq_v[0]})
-                    st.success("MQ Rule Added")
+                st.caption("When the syntax is generated, groups coded 0/1 in every row are tallied with COUNT (value 1); any other coding is summed with SUM().")
+                if st.form_submit_button("Add MQ Rule"):
+                    if mq_v:
+                        group_name = mq_g if mq_g != "-- Select --" else mq_v[0]
+                        st.session_state.mq_rules[group_name] = {'variables': mq_v, 'min_c': min_c, 'group_name': group_name}
+                        st.success("MQ Rule Added")
+                    else:
+                        st.warning("Select at least one variable for the MQ rule.")
 
         with tab_oe:
             st.subheader("Open Ended Configuration")
-            str_vars = [c for c in st.session_state.all_cols if is_string(c)]
-            oe_sel = st.multiselect("Select Variables", str_vars, key="oe_multi")
+            oe_sel = st.multiselect("Select Variables", st.session_state.str_vars, key="oe_multi")
             if st.button("Configure Selected OE"):
                 st.session_state.oe_batch_vars = oe_sel
 
             if st.session_state.oe_batch_vars:
                 with st.form("oe_form"):
+                    rows = []
                     for c in st.session_state.oe_batch_vars:
+                        saved = st.session_state.string_rules.get(c, {})
                         st.markdown(f"**OE Trigger for {c}**")
-                        tr = st.selectbox(f"Trigger {c}", all_options, key=f"oet_{c}")
-                        tv = st.text_input(f"Value {c}", "1", key=f"oev_{c}")
-                        if st.form_submit_button(f"Save OE {c}"):
-                            st.session_state.string_rules.append({'variable':c, 'trig':tr, 'trig_v':tv})
-                            st.toast(f"Saved {c}")
+                        tr = st.selectbox(f"Trigger {c}", all_opts, index=opt_index.get(saved.get('trig'), 0), key=f"oet_{c}")
+                        tv = st.text_input(f"Value {c}", saved.get('trig_v', "1"), key=f"oev_{c}")
+                        rows.append((c, tr, tv))
+                    if st.form_submit_button("Save All OE Rules"):
+                        st.session_state.string_rules.update(
+                            (c, {'variable':c, 'trig':tr, 'trig_v':tv}) for c, tr, tv in rows
+                        )
+                        st.toast(f"Saved {len(rows)} OE rules")
 
         with tab_sl:
             st.subheader("Straightlining")
-            sl_g = st.selectbox("Select Grid Group", ["-- Select --"] + list(groups.keys()), key="sl_g_sel")
-            if sl_g != "-- Select --" and st.button(f"Add Straightliner Check for {sl_g}"):
-                st.session_state.straightliner_rules.append({'variables': groups[sl_g], 'group_name': sl_g})
-                st.success(f"Added {sl_g}")
+            with st.form("sl_form"):
+                sl_g = st.selectbox("Select Grid Group", st.session_state.group_opts, key="sl_g_sel")
+                if st.form_submit_button("Add Straightliner Check") and sl_g != "-- Select --":
+                    st.session_state.straightliner_rules[sl_g] = {'variables': groups[sl_g], 'group_name': sl_g}
+                    st.success(f"Added {sl_g}")
 
         with tab_final:
             if st.button("Generate Final SPSS Syntax"):
-                master = ["* FINAL SYNTAX\n", "SET DECIMAL=DOT.\n"]
-                for r in st.session_state.sq_rules: master.extend(generate_sq_spss_syntax(r))
-                for r in st.session_state.mq_rules: master.extend(generate_mq_spss_syntax(r))
-                for r in st.session_state.string_rules: master.extend(generate_string_spss_syntax(r))
-                for r in st.session_state.straightliner_rules: master.extend(generate_straightliner_spss_syntax(r))
-                
-                final_text = "\n".join(master)
-                st.code(final_text, language="spss")
-                st.download_button("Download .sps", final_text, "SurveyValidation.sps")
\ No newline at end of file
+                # The tabs above only needed a row preview; the MQ tally choice and the flag preview need every row
+                with st.spinner("Reading all rows..."):
+                    df = load_data_file(uploaded_file, preview=False)
+                # COUNT only for groups that are 0/1 across the whole file; without it, SUM() is the safe choice
+                for r in st.session_state.mq_rules.values():
+                    r['binary'] = df is not None and is_binary_coded(df, r['variables'])
+                writers = (
+                    (st.session_state.sq_rules, generate_sq_spss_syntax),
+                    (st.session_state.mq_rules, generate_mq_spss_syntax),
+                    (st.session_state.string_rules, generate_string_spss_syntax),
+                    (st.session_state.straightliner_rules, generate_straightliner_spss_syntax),
+                )
+                # Every rule's lines flattened lazily and encoded straight into the download buffer:
+                # no master list and no full-script str alongside the bytes
+                buf = io.BytesIO()
+                for line in chain(
+                    ["* FINAL SYNTAX\n", "SET DECIMAL=DOT.\n"],
+                    *(chain.from_iterable(map(gen, rules.values())) for rules, gen in writers),
+                ):
+                    buf.write(f"{line}\n".encode("utf-8"))
+                buf.seek(0)
+                st.code(b"".join(islice(buf, SYNTAX_PREVIEW_LINES)).decode("utf-8"), language="spss")
+                if buf.read(1):
+                    st.caption(f"Showing the first {SYNTAX_PREVIEW_LINES} lines; download the .sps file for the complete syntax.")
+                st.download_button("Download .sps", buf, "SurveyValidation.sps", mime="text/plain")
+
+                show_validation_preview(df)
\ No newline at end of file
@@ -0,0 +1,96 @@
+import importlib.util
+import io
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+APP_PATH = Path(__file__).resolve().parent.parent / "27app.py"
+
+
+@pytest.fixture(scope="module")
+def app():
+    # 27app.py is a Streamlit script (and not an importable module name): with no upload it only
+    # defines its helpers and draws the sidebar, so it can be loaded in Streamlit's bare mode
+    spec = importlib.util.spec_from_file_location("app27", APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_excel_report_keeps_every_cell(app):
+    df = pd.DataFrame({
+        "Q1": [1, 2, 3],
+        "Q4_OE": ["x", None, "z"],
+        "Q5": [1.5, np.nan, 2.0],
+    })
+    flags = pd.DataFrame({"xxQ1_Rng": [True, False, True], "xxQ4_OE_Str": [False, True, False]})
+
+    report = pd.read_excel(io.BytesIO(app.generate_excel_report(df, flags)))
+
+    expected = pd.concat([df, flags.astype(int)], axis=1)
+    pd.testing.assert_frame_equal(report, expected, check_dtype=False)
+
+
+def test_csv_upload_uses_the_shared_reader(app):
+    upload = io.BytesIO(b"sys_respnum,Q1,Q1,Q2\n1,1,2,3\n2,4,5\n")
+    upload.name = "survey.csv"
+
+    df = app._parse_upload(".csv", upload)
+
+    assert df.columns.tolist() == ["Q1", "Q1.1", "Q2"]
+    assert df["Q1.1"].tolist() == [2, 5]
+    assert pd.isna(df["Q2"].iloc[1])
+
+
+def test_skip_flags_need_the_trigger_and_a_missing_answer(app):
+    df = pd.DataFrame({
+        "Q0": [1, 1, 2, 1],
+        "Q1": [np.nan, 3, np.nan, 2],
+        "Q4_OE": ["yes", "", "", "no"],
+        "Q5_OE": [None, "txt", None, ""],
+    })
+    sq_rules = {"Q1": {"variable": "Q1", "min_val": 1, "max_val": 5, "trig": "Q0", "trig_v": "1"}}
+    string_rules = {
+        "Q5_OE": {"variable": "Q5_OE", "trig": "Q4_OE", "trig_v": "no"},
+        "Q4_OE": {"variable": "Q4_OE", "trig": "-- Select Variable --", "trig_v": "1"},
+    }
+
+    flags = app.compute_validation_flags(df, sq_rules, {}, string_rules, {}, frozenset({"Q4_OE", "Q5_OE"}))
+
+    assert flags["xxQ1_Skip"].tolist() == [True, False, False, False]
+    assert flags["xxQ5_OE_Skip"].tolist() == [False, False, False, True]
+    assert "xxQ4_OE_Skip" not in flags
+
+
+def test_string_columns_are_part_of_the_flag_cache_key(app):
+    df = pd.DataFrame({"Q0": ["1", "1"], "Q1": [np.nan, 2.0]})
+    sq_rules = {"Q1": {"variable": "Q1", "min_val": 1, "max_val": 5, "trig": "Q0", "trig_v": "1"}}
+
+    # Same data and rules: only the string/numeric split differs, so the cached result must not be reused
+    as_text = app.compute_validation_flags(df, sq_rules, {}, {}, {}, frozenset({"Q0"}))
+    as_number = app.compute_validation_flags(df, sq_rules, {}, {}, {}, frozenset())
+
+    assert as_text["xxQ1_Skip"].tolist() == [True, False]
+    assert as_number["xxQ1_Skip"].tolist() == [False, False]
+
+
+def test_validation_preview_skips_a_failed_full_read(app, monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("flags computed without data")
+
+    monkeypatch.setattr(app, "compute_validation_flags", fail)
+
+    assert app.show_validation_preview(None) is None
+
+
+def test_mq_groups_use_count_only_when_0_1_coded(app):
+    df = pd.DataFrame({"Q2_1": [1, 0, np.nan], "Q2_2": [0, 1, 0], "Q3_1": [1, 2, 0]})
+
+    assert app.is_binary_coded(df, ["Q2_1", "Q2_2"])
+    assert not app.is_binary_coded(df, ["Q2_1", "Q3_1"])
+
+    rule = {"variables": ["Q2_1", "Q2_2"], "min_c": 1, "group_name": "Q2"}
+    assert "COMPUTE Q2_Sum = SUM(Q2_1 Q2_2)." in app.generate_mq_spss_syntax(rule)
+    assert "COUNT Q2_Sum = Q2_1 Q2_2 (1)." in app.generate_mq_spss_syntax({**rule, "binary": True})
@@ -0,0 +1,52 @@
+import io
+
+import pandas as pd
+
+from validation_core import load_data_file
+
+
+def _upload(data, name):
+    f = io.BytesIO(data)
+    f.name = name
+    return f
+
+
+def test_csv_datetime_columns_stay_text():
+    data = (
+        b"Start_Date,Visit_Day,Q1_1\n"
+        b"2024-01-05 10:00:00,2024-01-05,1\n"
+        b"2024-01-06T11:00:00,,0\n"
+    )
+    df = load_data_file(_upload(data, "survey.csv"))
+
+    assert df["Start_Date"].dtype == object
+    assert df["Start_Date"].tolist() == ["2024-01-05 10:00:00", "2024-01-06T11:00:00"]
+    assert df["Visit_Day"].dtype == object
+    assert df["Visit_Day"].iloc[0] == "2024-01-05"
+    assert pd.isna(df["Visit_Day"].iloc[1])
+    assert pd.api.types.is_integer_dtype(df["Q1_1"])
+
+
+def test_csv_short_rows_are_padded_with_missing_values():
+    data = b"Q1,Q2,Q3\n1,2,3\n4,5\n"
+    df = load_data_file(_upload(data, "survey.csv"))
+
+    assert df.columns.tolist() == ["Q1", "Q2", "Q3"]
+    assert df["Q2"].tolist() == [2, 5]
+    assert pd.isna(df["Q3"].iloc[1])
+
+
+def test_csv_repeated_headers_are_renamed_like_read_csv():
+    data = b"Q1,Q1,Q1.1,Q1\n1,2,3,4\n"
+    df = load_data_file(_upload(data, "survey.csv"))
+
+    assert df.columns.tolist() == ["Q1", "Q1.2", "Q1.1", "Q1.3"]
+    assert df["Q1.2"].tolist() == [2]
+
+
+def test_csv_pandas_null_tokens_are_missing():
+    data = b"Q1,Q2\nNone,<NA>\n1,x\n"
+    df = load_data_file(_upload(data, "survey.csv"))
+
+    assert df["Q1"].isna().tolist() == [True, False]
+    assert df["Q2"].isna().tolist() == [True, False]
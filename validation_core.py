@@ -0,0 +1,680 @@
+# Shared validation core for the variable-centric apps (27novapp.py, 10decapp.py):
+# data loading and all KnowledgeExcel SPSS syntax generators live here once.
+import streamlit as st
+import pandas as pd
+import os
+import sys
+import shutil
+import tempfile
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import chain
+
+# --- Configuration ---
+FLAG_PREFIX = "xx"
+# SPSS files above this size are decoded across several processes; below it the pool start-up costs more than it saves
+SAV_PARALLEL_MIN_BYTES = 64 * 1024 * 1024
+
+
+# --- DATA LOADING FUNCTION ---
+def _dedupe_columns(names):
+    """Renames repeated headers the way pd.read_csv does: Q1, Q1 -> Q1, Q1.1 (skipping names already in use)."""
+    taken = set(names)
+    counts = {}
+    deduped = []
+    for name in names:
+        n = counts.get(name, 0)
+        if n:
+            while f"{name}.{n}" in taken:
+                n += 1
+            taken.add(f"{name}.{n}")
+            deduped.append(f"{name}.{n}")
+        else:
+            deduped.append(name)
+        counts[name] = n + 1
+    return deduped
+
+
+def _read_csv_arrow(uploaded_file, encoding, na_values):
+    """Parses a CSV with pyarrow's multithreaded reader (type inference runs in native code across blocks)."""
+    import pyarrow as pa
+    from pyarrow import csv as pacsv
+    
+    def read(column_types=None):
+        uploaded_file.seek(0) # Ensure pointer is at start
+        return pacsv.read_csv(
+            uploaded_file,
+            read_options=pacsv.ReadOptions(encoding=encoding),
+            # Arrow's default null tokens are pandas' keep_default_na list minus 'None' and '<NA>'; those and ours go on top
+            convert_options=pacsv.ConvertOptions(
+                column_types=column_types,
+                null_values=[*pacsv.ConvertOptions().null_values, 'None', '<NA>', *na_values], strings_can_be_null=True
+            ),
+        )
+    
+    try:
+        table = read()
+    except pa.ArrowInvalid:
+        # Rows with missing trailing fields are a parse error to Arrow; pd.read_csv pads them with NaN
+        uploaded_file.seek(0)
+        return pd.read_csv(uploaded_file, encoding=encoding, na_values=na_values)
+    # Arrow types invalid UTF-8 text as binary instead of failing, so surface it to trigger the encoding fallback
+    if any(pa.types.is_binary(f.type) for f in table.schema):
+        raise UnicodeDecodeError(encoding, b'', 0, 1, "invalid bytes in text column")
+    # Arrow infers timestamp/date/time columns, which pd.read_csv left as object text (and the variable
+    # detection compares numerically): re-read just those columns as strings to keep their original spelling
+    temporal_cols = {f.name: pa.string() for f in table.schema if pa.types.is_temporal(f.type)}
+    if temporal_cols:
+        table = read(temporal_cols)
+    # All-empty columns come back as Arrow null type: keep them numeric, as pd.read_csv did
+    table = table.cast(pa.schema([f.with_type(pa.float64()) if pa.types.is_null(f.type) else f for f in table.schema]))
+    # Arrow keeps repeated header names as-is, which would make df[col] return a DataFrame
+    return table.rename_columns(_dedupe_columns(table.column_names)).to_pandas()
+
+
+@contextmanager
+def _upload_path(uploaded_file, suffix):
+    """Yields a filesystem path holding the upload: a RAM-backed memfd on Linux, a temporary file elsewhere."""
+    uploaded_file.seek(0) # Ensure pointer is at start
+    if sys.platform == 'linux' and hasattr(os, 'memfd_create'):
+        fd = os.memfd_create(f"upload{suffix}")
+        try:
+            with os.fdopen(fd, 'wb', closefd=False) as mem_file:
+                shutil.copyfileobj(uploaded_file, mem_file, length=8 << 20)
+            # Addressed through our pid (not /proc/self) so reader worker processes can open it too
+            yield f"/proc/{os.getpid()}/fd/{fd}"
+        finally:
+            os.close(fd)
+    else:
+        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_file:
+            # Stream the UploadedFile to the temporary file in 8MB chunks (no full in-memory copy)
+            shutil.copyfileobj(uploaded_file, tmp_file, length=8 << 20)
+        try:
+            yield tmp_file.name
+        finally:
+            os.remove(tmp_file.name)
+
+
+def load_data_file(uploaded_file):
+    """Reads data from CSV, Excel, or SPSS data files, handling different formats."""
+    
+    file_extension = os.path.splitext(uploaded_file.name)[1].lower()
+    
+    # Define NA values for CSV/Excel
+    na_values = ['', ' ', '#N/A', 'N/A', 'NA', '#NA', 'NULL', 'null']
+    
+    if file_extension in ['.csv']:
+        # Try common encodings for CSV
+        try:
+            # Attempt UTF-8 first
+            return _read_csv_arrow(uploaded_file, 'utf-8', na_values)
+        except Exception:
+            try:
+                # Try Latin-1 (the reader resets the file pointer itself)
+                return _read_csv_arrow(uploaded_file, 'latin-1', na_values)
+            except Exception as e:
+                raise Exception(f"Failed to read CSV with both UTF-8 and Latin-1 encodings. Error: {e}")
+    
+    elif file_extension in ['.xlsx', '.xls']:
+        # Excel files
+        uploaded_file.seek(0) # Ensure pointer is at start
+        return pd.read_excel(uploaded_file)
+    
+    # CORRECTED LOGIC FOR SPSS FILES (.sav, .zsav) - Uses Temporary File Path
+    elif file_extension in ['.sav', '.zsav']:
+        try:
+            import pyreadstat
+            
+            # 1. pyreadstat needs a path, not the "expected str, bytes... not BytesIO" UploadedFile:
+            #    memfd on Linux skips the disk round-trip, a temporary file elsewhere (both cleaned up on exit)
+            with _upload_path(uploaded_file, file_extension) as sav_path:
+                # 2. Read the data straight through pyreadstat (raw codes, no datetime conversion),
+                #    splitting the row decoding across processes for large files
+                read_kwargs = dict(apply_value_formats=False, disable_datetime_conversion=True)
+                if os.path.getsize(sav_path) >= SAV_PARALLEL_MIN_BYTES:
+                    df, _meta = pyreadstat.read_file_multiprocessing(
+                        pyreadstat.read_sav, sav_path,
+                        num_processes=max(2, (os.cpu_count() or 2) // 2), **read_kwargs
+                    )
+                else:
+                    df, _meta = pyreadstat.read_sav(sav_path, **read_kwargs)
+            
+            return df
+            
+        except ImportError:
+            st.error("Error: Reading SPSS files requires the 'pyreadstat' library. Please ensure it is in your requirements.txt.")
+            raise
+        except Exception as e:
+            raise Exception(f"Failed to read SPSS data file. Please ensure it is a valid .sav or .zsav file. Error: {e}")
+    
+    else:
+        raise Exception(f"Unsupported file format: {file_extension}. Please upload CSV, Excel (.xlsx/.xls), or SPSS (.sav/.zsav).")
+
+
+# --- CORE UTILITY FUNCTIONS (SYNTAX GENERATION) ---
+
+@lru_cache(maxsize=4096)
+def _base_name(col):
+    """Question stem used for filter/set flag names: Q1_2 -> Q1, Q5 -> Q5."""
+    return col.split('_', 1)[0]
+
+
+@lru_cache(maxsize=4096)
+def _stem_flags(col):
+    """Question stem plus its filter and skip-error flag names: Q1_2 -> (Q1, Flag_Q1, xxQ1)."""
+    stem = _base_name(col)
+    return stem, f"Flag_{stem}", f"{FLAG_PREFIX}{stem}"
+
+
+# EoO / EoC condition builders for the skip check, keyed by rule type (MQ/Ranking/General use the default)
+_SKIP_CONDITIONS = {
+    # EoO: Trigger met AND (Missing OR Out-of-Range); EoC: Trigger NOT met AND (Answered)
+    'SQ': lambda t, mn, mx: (f"(miss({t}) | ~range({t},{mn},{mx}))", f"~miss({t})"),
+    'String': lambda t, mn, mx: (f"{t}=''", f"{t}<>''"),
+}
+
+
+def _skip_conditions_default(t, mn, mx):
+    """EoO / EoC conditions for MQ, Ranking and General skips: missing vs. answered."""
+    return f"miss({t})", f"~miss({t})"
+
+
+# Closes a block of transformations; SPSS runs pending IFs in order in one data pass, so a rule needs only one
+_EXECUTE = "EXECUTE.\n"
+
+
+def _first_filter(seen_filters, filter_flag, trigger_col, trigger_val):
+    """True unless this exact Flag_Qx filter IF was already emitted into the script (then it is redundant)."""
+    if seen_filters is None:
+        return True
+    key = (filter_flag, trigger_col, str(trigger_val))
+    if key in seen_filters:
+        return False
+    seen_filters.add(key)
+    return True
+
+
+def generate_skip_spss_syntax(target_col, trigger_col, trigger_val, rule_type, range_min=None, range_max=None, defer_execute=False, seen_filters=None):
+    """
+    Generates detailed SPSS syntax for Skip Logic (Error of Omission/Commission)
+    using the two-stage process: Flag_Qx (intermediate filter) -> xxQx (final EoO/EoC flag).
+    With defer_execute the EXECUTE. lines are left out for the caller to emit once; with
+    seen_filters the Flag_Qx stage is only written the first time across the script.
+    """
+    execute = '' if defer_execute else _EXECUTE
+    target_clean, filter_flag, final_error_flag = _stem_flags(target_col)
+    
+    # An SQ rule without a range is checked like a general one
+    if rule_type == 'SQ' and (range_min is None or range_max is None):
+        rule_type = None
+    eoo_condition, eoc_condition = _SKIP_CONDITIONS.get(rule_type, _skip_conditions_default)(target_col, range_min, range_max)
+    
+    # Stage 1: Filter Flag (Flag_Qx), then Stage 2: EoO (Flag=1) / EoC (Flag=2) on the target.
+    # Each stage is one multi-line string (a single list entry) instead of a dozen appended lines.
+    syntax = []
+    if _first_filter(seen_filters, filter_flag, trigger_col, trigger_val):
+        syntax.append(f"""\
+**************************************SKIP LOGIC FILTER FLAG: {trigger_col}={trigger_val} -> {target_clean}
+* Qx should ONLY be asked if {trigger_col} = {trigger_val}.
+IF({trigger_col} = {trigger_val}) {filter_flag}=1.
+{execute}""")
+    syntax.append(f"""\
+**************************************SKIP LOGIC EoO/EoC CHECK: {target_col} -> {final_error_flag}
+* EoO (1): Trigger Met ({filter_flag}=1), Target Fails Check/Missing/Out-of-Range/Empty.
+IF({filter_flag} = 1 & {eoo_condition}) {final_error_flag}=1.
+* EoC (2): Trigger Not Met ({filter_flag}<>1 | miss({filter_flag})), Target Answered.
+IF(({filter_flag} <> 1 | miss({filter_flag})) & {eoc_condition}) {final_error_flag}=2.
+{execute}""")
+    
+    return syntax, [filter_flag, final_error_flag]
+
+
+def generate_other_specify_spss_syntax(main_col, other_col, other_stub_val, defer_execute=False):
+    """
+    Generates syntax for Other-Specify checks (Both forward and reverse conditions).
+    """
+    execute = '' if defer_execute else _EXECUTE
+    main_clean = _base_name(main_col)
+        
+    flag_name_fwd = f"{FLAG_PREFIX}{main_clean}_OtherFwd"
+    flag_name_rev = f"{FLAG_PREFIX}{main_clean}_OtherRev"
+    
+    # Forward Check (Main selected, Other is empty/missing) - EoO type check, then
+    # Reverse Check (Other answered, Main not selected) - EoC type check
+    syntax = [f"""\
+**************************************OTHER SPECIFY (Forward) Check: {main_col}={other_stub_val} AND {other_col} is missing/blank
+* EoO (1): Main selected ({main_col}={other_stub_val}), Other is missing/blank.
+IF({main_col}={other_stub_val} & ({other_col}='' | miss({other_col}))) {flag_name_fwd}=1.
+{execute}
+**************************************OTHER SPECIFY (Reverse) Check: {other_col} has data AND {main_col}<>{other_stub_val}
+* EoC (2): Other has data (~miss({other_col}) & {other_col}<>''), Main not selected.
+IF(~miss({other_col}) & {other_col}<>'' & {main_col}<>{other_stub_val}) {flag_name_rev}=1.
+{execute}"""]
+    
+    return syntax, [flag_name_fwd, flag_name_rev]
+
+def generate_piping_spss_syntax(target_col, overall_skip_filter_flag, piping_source_col, piping_stub_val, defer_execute=False):
+    """
+    Generates syntax for the Rating Piping/Reverse Condition check.
+    """
+    execute = '' if defer_execute else _EXECUTE
+    flag_col = f"{FLAG_PREFIX}{target_col}" 
+    
+    # EOC Condition: (Flag_Qx<>1 OR miss(Flag_Qx) OR Q_source<>i OR miss(Q_source)) AND ~miss(Target)
+    eoc_condition = f"({overall_skip_filter_flag}<>1 | miss({overall_skip_filter_flag}) | {piping_source_col}<>{piping_stub_val} | miss({piping_source_col})) & ~miss({target_col})"
+    
+    # 1. Error of Omission (EOO) - Target is missing/wrong when piping condition is met
+    # 2. Error of Commission (EOC / Reverse Condition) - Target has data when piping condition is NOT met
+    syntax = [f"""\
+**************************************PIPING (EOO) Check: (Filter={overall_skip_filter_flag}=1) AND ({piping_source_col}={piping_stub_val}) AND {target_col}<>{piping_stub_val}
+* EoO (1): Piping/Skip met, Target value is wrong/missing. IF(((Flag_Q12=1) & Q11=1 ) & Q12_1<>1)xxQ12_1=1.
+IF(({overall_skip_filter_flag}=1) & ({piping_source_col}={piping_stub_val}) & {target_col}<>{piping_stub_val}) {flag_col}=1.
+**************************************PIPING (EOC / Reverse) Check: (Filter NOT met OR Piping NOT met) AND {target_col} is answered
+* EoC (2): Skip/Piping not met, Target value is wrongly answered. IF((Flag_Q12<>1 | miss(Flag_Q12) | Q11<>1 | miss(Q11)) & ~miss(Q12_1))xxQ12_1=2.
+IF({eoc_condition}) {flag_col}=2.
+{execute}"""]
+    
+    return syntax, [flag_col]
+
+
+def generate_sq_spss_syntax(rule, seen_filters=None):
+    """Generates detailed SPSS syntax for a single Single Select check."""
+    col = rule['variable']
+    min_val = rule['min_val']
+    max_val = rule['max_val']
+    required_stubs_list = rule['required_stubs']
+    other_var = rule.get('other_var')
+    run_skip = rule['run_skip']
+    run_piping = rule['run_piping_check']
+    trigger_col = rule['trigger_col']
+    
+    target_clean, filter_flag, _ = _stem_flags(col)
+        
+    syntax = []
+    generated_flags = []
+
+    # 1. Missing/Range Check 
+    if not run_piping:
+        flag_name = f"{FLAG_PREFIX}{col}_Rng"
+        syntax.append(f"""\
+**************************************SQ Missing/Range Check: {col} (Range: {min_val} to {max_val})
+IF(miss({col}) | ~range({col},{min_val},{max_val})) {flag_name}=1.
+""")
+        generated_flags.append(flag_name)
+    
+    # 2. Specific Stub Check (ANY)
+    if required_stubs_list:
+        stubs_str = ', '.join(map(str, required_stubs_list))
+        flag_any = f"{FLAG_PREFIX}{col}_Any"
+        syntax.append(f"""\
+**************************************SQ Specific Stub Check (Not IN Acceptable List): {col} (Accept: {stubs_str})
+IF(~miss({col}) & NOT(any({col}, {stubs_str}))) {flag_any}=1.
+""")
+        generated_flags.append(flag_any)
+
+    # 3. Other Specify Check
+    if other_var and other_var != '-- Select Variable --':
+        other_syntax, other_flags = generate_other_specify_spss_syntax(col, other_var, rule['other_stub_val'], defer_execute=True)
+        syntax.extend(other_syntax)
+        generated_flags.extend(other_flags)
+
+    # --- Combined Skip/Piping Checks ---
+    if (run_skip or run_piping) and trigger_col != '-- Select Variable --':
+        
+        trigger_val = rule['trigger_val']
+        
+        # B. Generate Filter Flag (Flag_Qx); the skip stage below then never repeats it
+        if seen_filters is None:
+            seen_filters = set()
+        if _first_filter(seen_filters, filter_flag, trigger_col, trigger_val):
+            syntax.append(f"""\
+**************************************SQ Filter Flag for Skip/Piping: {filter_flag}
+* Filter for {target_clean}: {trigger_col} = {trigger_val}.
+IF({trigger_col} = {trigger_val}) {filter_flag}=1.
+""")
+        generated_flags.append(filter_flag)
+        
+        # C. Piping/Reverse Condition Check
+        if run_piping and rule['piping_source_col'] != '-- Select Variable --':
+            pipe_syntax, pipe_flags = generate_piping_spss_syntax(
+                col, filter_flag, rule['piping_source_col'], rule['piping_stub_val'], defer_execute=True
+            )
+            syntax.extend(pipe_syntax)
+            generated_flags.extend(pipe_flags)
+        
+        # D. Standard Skip Logic (EoO/EoC) - Only if Piping is NOT run on this specific variable
+        elif run_skip:
+            sl_syntax, sl_flags = generate_skip_spss_syntax(
+                col, trigger_col, trigger_val, 'SQ', min_val, max_val, defer_execute=True, seen_filters=seen_filters
+            )
+            syntax.extend(sl_syntax)
+            generated_flags.extend(sl_flags)
+    
+    # The stanzas above leave out their own EXECUTE. so the whole rule runs in a single data pass
+    if syntax:
+        syntax.append(_EXECUTE)
+        
+    return syntax, generated_flags 
+
+# NEW FUNCTION: Generate Straightliner Syntax
+def generate_straightliner_spss_syntax(cols):
+    """
+    Generates SPSS syntax for a Maximum Straightliner check (MIN=MAX).
+    This flags respondents who gave the exact same answer for all items in the grid.
+    """
+    cols_str = ' '.join(cols)
+    set_name = _base_name(cols[0]) if cols else 'Rating_Set'
+    flag_name_max_str = f"{FLAG_PREFIX}{set_name}_MaxStr"
+    
+    # Calculate MIN and MAX for the row/case, flag 1 if MIN = MAX AND at least one item
+    # is answered (to ignore fully missing cases), then clean up the temporary variables
+    syntax = [f"""\
+**************************************STRAIGHTLINER CHECK: {set_name} (Max: All Items Same Value)
+* Check if the minimum value equals the maximum value across the grid items for a single respondent.
+COMPUTE #Min_Val = MIN({cols_str}).
+COMPUTE #Max_Val = MAX({cols_str}).
+IF(#Min_Val = #Max_Val & ~miss({cols[0]})) {flag_name_max_str}=1.
+EXECUTE.
+
+DELETE VARIABLES #Min_Val #Max_Val.
+EXECUTE.
+"""]
+
+    return syntax, [flag_name_max_str]
+
+def generate_mq_spss_syntax(rule, seen_filters=None):
+    """Generates detailed SPSS syntax for a Multi-Select check."""
+    cols = rule['variables']
+    mq_set_name = _base_name(cols[0]) if cols else 'MQ_Set'
+    mq_list_str = ' '.join(cols)
+    calc_func = "SUM" if rule['count_method'] == "SUM" else "COUNT"
+    mq_sum_var = f"{mq_set_name}_Count"
+
+    syntax = []
+    generated_flags = []
+    
+    # 1. Count Calculation
+    syntax.append(f"""\
+**************************************MQ Count Calculation for Set: {mq_set_name} (Method: {calc_func})
+COMPUTE {mq_sum_var} = {calc_func}({mq_list_str}).
+EXECUTE.
+""")
+    generated_flags.append(mq_sum_var)
+    
+    # 2. Min/Max Count Check
+    flag_min = f"{FLAG_PREFIX}{mq_set_name}_Min"
+    syntax.append(f"""\
+**************************************MQ Minimum Count Check: {mq_set_name} (Min: {rule['min_count']})
+IF({mq_sum_var} < {rule['min_count']} & ~miss({cols[0]})) {flag_min}=1.
+EXECUTE.
+""")
+    generated_flags.append(flag_min)
+    
+    if rule['max_count'] and rule['max_count'] > 0:
+        flag_max = f"{FLAG_PREFIX}{mq_set_name}_Max"
+        syntax.append(f"""\
+**************************************MQ Maximum Count Check: {mq_set_name} (Max: {rule['max_count']})
+IF({mq_sum_var} > {rule['max_count']}) {flag_max}=1.
+EXECUTE.
+""")
+        generated_flags.append(flag_max)
+
+    # 3. Exclusive Stub Check
+    exclusive_col = rule['exclusive_col']
+    if exclusive_col and exclusive_col != 'None' and exclusive_col in cols:
+        flag_exclusive = f"{FLAG_PREFIX}{mq_set_name}_Exclusive"
+        exclusive_value = 1 
+        other_cols_str = ' '.join([c for c in cols if c != exclusive_col])
+        syntax.append(f"""\
+**************************************MQ Exclusive Stub Check: {exclusive_col} vs Others
+COMPUTE #Other_Count = SUM({other_cols_str}).
+IF({exclusive_col}={exclusive_value} & #Other_Count > 0) {flag_exclusive}=1.
+EXECUTE.
+
+DELETE VARIABLES #Other_Count.
+""")
+        generated_flags.append(flag_exclusive)
+
+    # 4. Other Specify Check
+    if rule.get('other_var') and rule['other_var'] != 'None' and rule.get('other_checkbox_col') and rule['other_checkbox_col'] != 'None':
+         other_syntax, other_flags = generate_other_specify_spss_syntax(rule['other_checkbox_col'], rule['other_var'], rule['other_stub_val'])
+         syntax.extend(other_syntax)
+         generated_flags.extend(other_flags)
+
+    # 5. Skip Logic (EoO/EoC) - uses the base question name as proxy
+    if rule['run_skip'] and rule['trigger_col'] != '-- Select Variable --':
+        target_col = mq_set_name 
+        sl_syntax, sl_flags = generate_skip_spss_syntax(
+            target_col, rule['trigger_col'], rule['trigger_val'], 'MQ', seen_filters=seen_filters
+        )
+        syntax.extend(sl_syntax)
+        generated_flags.extend(sl_flags)
+
+    return syntax, generated_flags
+
+def generate_string_spss_syntax(rule, seen_filters=None):
+    """
+    Generates detailed SPSS syntax for a String check.
+    """
+    col = rule['variable']
+    min_length = rule['min_length']
+    
+    syntax = []
+    generated_flags = []
+
+    # 1. Junk/Min Length Check 
+    if min_length and min_length > 0:
+        flag_length = f"{FLAG_PREFIX}{col}_Junk"
+        # Flag 1 if answered (not miss or '') AND length < min_length
+        syntax.append(f"""\
+**************************************String Junk Check: {col} (Min Length: {min_length} chars)
+IF(~miss({col}) & {col}<>'' & LENGTH(RTRIM({col})) < {min_length}) {flag_length}=1.
+EXECUTE.
+""")
+        generated_flags.append(flag_length)
+    
+    # 2. Explicit Missing Check (Only run if NO skip logic is enabled)
+    if not rule['run_skip']:
+        flag_missing = f"{FLAG_PREFIX}{col}_Miss"
+        # Flag 1 if missing or empty string
+        syntax.append(f"""\
+**************************************String Missing Check: {col} (Missing Mandatory Check)
+IF({col}='' | miss({col})) {flag_missing}=1.
+EXECUTE.
+""")
+        generated_flags.append(flag_missing)
+        
+    # 3. Skip Logic (EoO/EoC) 
+    if rule['run_skip'] and rule['trigger_col'] != '-- Select Variable --':
+        sl_syntax, sl_flags = generate_skip_spss_syntax(
+            col, rule['trigger_col'], rule['trigger_val'], 'String', seen_filters=seen_filters
+        )
+        syntax.extend(sl_syntax)
+        generated_flags.extend(sl_flags)
+        
+    return syntax, generated_flags
+def generate_ranking_spss_syntax(rule, seen_filters=None):
+    """Generates detailed SPSS syntax for a Ranking check."""
+    cols = rule['variables']
+    min_rank = rule['min_rank']
+    max_rank = rule['max_rank']
+    rank_set_name = _base_name(cols[0]) if cols else 'Rank_Set'
+    rank_list_str = ' '.join(cols)
+    flag_base = f"{FLAG_PREFIX}{rank_set_name}"
+    
+    syntax = []
+    generated_flags = []
+    
+    # 1. Duplicate Rank Check
+    flag_duplicate = f"{flag_base}_Dup"
+    syntax.append(f"""\
+**************************************Ranking Duplicate Check: {rank_set_name}
+COMPUTE {flag_duplicate} = 0.
+LOOP #rank = {min_rank} TO {max_rank}.
+  COUNT #rank_count = {rank_list_str} (#rank).
+  IF(#rank_count > 1) {flag_duplicate}=1.
+END LOOP.
+EXECUTE.
+""")
+    generated_flags.append(flag_duplicate)
+    
+    # 2. Rank Range Check
+    flag_range_name = f"{flag_base}_Rng"
+    # One DO REPEAT block over the set instead of an IF line per ranking column
+    syntax.append(f"""\
+**************************************Ranking Range Check: {rank_set_name} (Range: {min_rank} to {max_rank})
+COMPUTE {flag_range_name} = 0.
+DO REPEAT X = {rank_list_str}.
+  IF(~miss(X) & ~range(X,{min_rank},{max_rank})) {flag_range_name}=1.
+END REPEAT.
+EXECUTE.
+""")
+    generated_flags.append(flag_range_name)
+    
+    # 3. Skip Logic (EoO/EoC) - uses the base variable name as proxy
+    if rule['run_skip'] and rule['trigger_col'] != '-- Select Variable --':
+        target_col = rank_set_name
+        sl_syntax, sl_flags = generate_skip_spss_syntax(
+            target_col, rule['trigger_col'], rule['trigger_val'], 'Ranking', seen_filters=seen_filters
+        )
+        syntax.extend(sl_syntax)
+        generated_flags.extend(sl_flags)
+        
+    return syntax, generated_flags
+
+def generate_master_spss_syntax(sq_rules, mq_rules, ranking_rules, string_rules, straightliner_rules):
+    """Generates the final .sps file by iterating over all stored rules."""
+    all_syntax_blocks = []
+    all_flag_cols = []
+    # Flag_Qx filters already written; rules sharing a stem and trigger reuse the first one
+    seen_filters = set()
+    
+    # Process Rules
+    for rule in sq_rules:
+        syntax, flags = generate_sq_spss_syntax(rule, seen_filters)
+        all_syntax_blocks.append(syntax)
+        all_flag_cols.extend(flags)
+        
+    for rule in mq_rules:
+        syntax, flags = generate_mq_spss_syntax(rule, seen_filters)
+        all_syntax_blocks.append(syntax)
+        all_flag_cols.extend(flags)
+            
+    for rule in ranking_rules:
+        syntax, flags = generate_ranking_spss_syntax(rule, seen_filters)
+        all_syntax_blocks.append(syntax)
+        all_flag_cols.extend(flags)
+
+    for rule in straightliner_rules: # Straightliner Rules
+        syntax, flags = generate_straightliner_spss_syntax(rule['variables'])
+        all_syntax_blocks.append(syntax)
+        all_flag_cols.extend(flags)
+
+    for rule in string_rules:
+        syntax, flags = generate_string_spss_syntax(rule, seen_filters)
+        all_syntax_blocks.append(syntax) # Use all_syntax_blocks, not all_syntax_cols
+        all_flag_cols.extend(flags)
+
+
+    # --- Master Syntax Compilation ---
+    sps_content = []
+    sps_content.append(f"*{'='*60}*")
+    sps_content.append(f"* PYTHON-GENERATED DATA VALIDATION SCRIPT (KNOWLEDGEEXCEL FORMAT) *")
+    sps_content.append(f"*{'='*60}*\n")
+    sps_content.append("DATASET ACTIVATE ALL.")
+    sps_content.append("\n* --- 0. INITIALIZE FLAGS --- *")
+    
+    unique_flag_names = sorted(set(all_flag_cols))
+    
+    # One pass over the sorted names: final flags that need initialization (excluding counts/temp vars),
+    # intermediate Flag_Qx filters and string flags (numeric, but kept out of init_flags_0).
+    # Appending in that order keeps all_numeric_flags sorted and unique.
+    init_flags_0 = []
+    intermediate_flags = []
+    string_flags = []
+    all_numeric_flags = []
+    for f in unique_flag_names:
+        is_string_flag = f.endswith(('_Miss', '_Junk'))
+        is_init = f.startswith(FLAG_PREFIX) and not is_string_flag and not f.endswith('_Count')
+        is_intermediate = f.startswith('Flag_')
+        if is_init:
+            init_flags_0.append(f)
+        if is_intermediate:
+            intermediate_flags.append(f)
+        if is_string_flag:
+            string_flags.append(f)
+        if is_init or is_intermediate or is_string_flag:
+            all_numeric_flags.append(f)
+    
+    if all_numeric_flags:
+        sps_content.append(f"NUMERIC {'; '.join(all_numeric_flags)}.")
+        
+        # Initialize the final flags to 0
+        if init_flags_0:
+            sps_content.append(f"RECODE {'; '.join(init_flags_0)} (ELSE=0).") 
+            
+        # Initialize intermediate flags to 0
+        if intermediate_flags:
+            sps_content.append(f"RECODE {'; '.join(intermediate_flags)} (ELSE=0).") 
+
+        # Initialize string flags to 0
+        if string_flags:
+            sps_content.append(f"RECODE {'; '.join(string_flags)} (ELSE=0).") 
+            
+    sps_content.append("EXECUTE.\n")
+    
+    # 1. Insert ALL detailed validation logic
+    sps_content.append("\n\n* --- 1. DETAILED VALIDATION LOGIC --- *")
+    sps_content.append("\n".join(chain.from_iterable(all_syntax_blocks)))
+    
+    # 2. Add Value Labels & Master Flags
+    sps_content.append("\n* --- 2. VALUE LABELS & VARIABLE INITIALIZATION --- *")
+    
+    # Flags sharing a label scheme get one VALUE LABELS statement with a variable list
+    data_check_flags = []
+    eoo_eoc_flags = []
+    filter_flags = []
+    for flag in unique_flag_names:
+        
+        if flag.startswith(FLAG_PREFIX) and flag.endswith(('_Rng', '_Any', '_OtherFwd', '_OtherRev', '_Min', '_Max', '_Dup', '_Miss', '_Junk', '_MaxStr')):
+            # General 'Fail: Data Check' for non-EoO/EoC flags
+            data_check_flags.append(flag)
+            
+        elif flag.startswith(FLAG_PREFIX) and not flag.endswith('_Count'):
+            # EoO/EoC flags (xxQx)
+            eoo_eoc_flags.append(flag)
+        
+        elif flag.startswith('Flag_'):
+             # Intermediate skip filter flags
+             filter_flags.append(flag)
+    
+    if data_check_flags:
+        sps_content.append(f"VALUE LABELS {' '.join(data_check_flags)} 0 'Pass' 1 'Fail: Data Check'.")
+    if eoo_eoc_flags:
+        sps_content.append(f"VALUE LABELS {' '.join(eoo_eoc_flags)} 0 'Pass' 1 'Fail: Error of Omission (EOO)' 2 'Fail: Error of Commission (EoC)'.")
+    if filter_flags:
+        sps_content.append(f"VALUE LABELS {' '.join(filter_flags)} 0 'Pass/Filter Not Met' 1 'Filter Flag Met (Intermediate)'.")
+            
+    sps_content.append("EXECUTE.\n")
+
+    # 3. Compute a Master Reject Flag
+    master_error_flags = [f for f in unique_flag_names if f.startswith(FLAG_PREFIX) or f.startswith('Flag_')]
+    
+    sps_content.append("\n* --- 3. MASTER REJECT COUNT COMPUTATION --- *")
+    if master_error_flags:
+        
+        # Only count final error flags (xx prefix, excluding calculated counts)
+        error_flags_to_count = [f for f in master_error_flags if f.startswith(FLAG_PREFIX) and not f.endswith('_Count')]
+        
+        if error_flags_to_count:
+            # (flag>0) is 1 for both 0/1 and 0/1/2 flags when failed, so the count needs no temporary binary flags
+            master_flag_logic = ', '.join([f'({f}>0)' for f in error_flags_to_count])
+            
+            sps_content.append(f"COMPUTE Master_Reject_Count = SUM({master_flag_logic}).")
+            sps_content.append("VARIABLE LABELS Master_Reject_Count 'Total Validation Errors (DV)'.")
+            sps_content.append("EXECUTE.")
+            
+            sps_content.append("\n* --- 4. VALIDATION REPORT (Frequencies) --- *")
+            sps_content.append(f"FREQUENCIES VARIABLES=Master_Reject_Count {'; '.join(error_flags_to_count)} /STATISTICS=COUNT MEAN.")
+        
+    return "\n".join(sps_content)